@@ -0,0 +1,48 @@
+'''Offline stand-ins for the images users link in memes, served over a local http server
+so `DrawImage` goes through the same fetching path as in the bot.'''
+import io
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+from aiohttp import web
+from PIL import Image
+
+
+def _photo(size, format: str) -> bytes:
+    '''noisy gradient, compresses about as badly as a real photo'''
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 48)
+    image = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    output = io.BytesIO()
+    image.save(output, format=format, quality=90)
+    return output.getvalue()
+
+
+def make_fixtures() -> Dict[str, bytes]:
+    '''filename -> image data. Generated, so they don't have to be checked in.'''
+    return {
+        'phone-photo.jpg': _photo((4032, 3024), 'JPEG'),
+        'reaction.jpg': _photo((800, 600), 'JPEG'),
+        'screenshot.png': _photo((1920, 1080), 'PNG'),
+    }
+
+
+@asynccontextmanager
+async def serve_fixtures(fixtures: Dict[str, bytes]) -> AsyncIterator[str]:
+    '''Serves `fixtures` on localhost, yields the base url'''
+    async def handler(request: web.Request) -> web.Response:
+        data = fixtures.get(request.match_info['name'])
+        if data is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=data)
+
+    app = web.Application()
+    app.router.add_get('/{name}', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    try:
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,52 @@
+'''Compares outline modes for white text, per template.
+
+    python -m benchmarks.outline [--repeat N]
+
+Only the draw phase is timed (template copy + every plugin's draw), encoding is left out.
+'''
+import argparse
+import asyncio
+import time
+from typing import List
+from meme_generator import ALL_MEMES, Meme, get_template_cache
+from meme_generator.plugins import OutlineMode
+from meme_generator.render import RenderSteps
+
+TEXT = 'when the meme / takes longer to render / than to write'
+
+
+def with_outline(meme: Meme, outline: OutlineMode) -> Meme:
+    plugins = [plugin.model_copy(update={'outline': outline}) if hasattr(plugin, 'outline') else plugin
+        for plugin in meme.plugins]
+    return meme.model_copy(update={'plugins': plugins})
+
+
+def time_draws(meme: Meme, steps: RenderSteps, repeat: int) -> float:
+    timings: List[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with get_template_cache().get(meme.image_filename) as image:
+            for index, prepared in steps:
+                meme.plugins[index].draw(image, prepared)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"meme":<22} {"offset ms":>10} {"stroke ms":>10} {"speedup":>8}')
+    for meme in ALL_MEMES:
+        if meme.aliases[0] == 'brain':  # image inputs need the network
+            continue
+        get_template_cache().warm([meme.image_filename])
+        steps = asyncio.run(meme.prepare(TEXT))
+        offset = time_draws(with_outline(meme, OutlineMode.OFFSET), steps, args.repeat)
+        stroke = time_draws(with_outline(meme, OutlineMode.STROKE), steps, args.repeat)
+        print(f'{meme.aliases[0]:<22} {offset * 1000:>10.2f} {stroke * 1000:>10.2f} {offset / stroke:>7.2f}x')
+
+
+if __name__ == '__main__':
+    run()
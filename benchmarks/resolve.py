@@ -0,0 +1,75 @@
+'''Alias resolution throughput of the meme registry, against the plain `CharTrie`
+lookup over raw input it replaced, and how fast typos get suggestions.
+
+    python -m benchmarks.resolve [--repeat N]
+'''
+import argparse
+import time
+from typing import Callable, List
+from pygtrie import CharTrie
+from meme_generator import ALL_MEMES, MemeRegistry
+
+TEXT = ' when the meme / takes longer to render / than to write'
+
+
+def make_commands() -> List[str]:
+    '''every alias as typed, in upper case and with extra spaces, plus some misses'''
+    commands = []
+    for meme in ALL_MEMES:
+        for alias in meme.aliases:
+            commands += [alias + TEXT, alias.upper() + TEXT, '  ' + alias.replace(' ', '   ') + TEXT]
+    commands += ['no such meme' + TEXT, 'x' + TEXT, '']
+    return commands
+
+
+def typo(alias: str) -> str:
+    '''alias with two letters swapped in the middle'''
+    middle = len(alias) // 2
+    return alias[:middle - 1] + alias[middle] + alias[middle - 1] + alias[middle + 1:]
+
+
+def throughput(resolve: Callable[[str], object], commands: List[str], repeat: int) -> float:
+    '''best resolutions per second out of `repeat` passes over every command'''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for command in commands:
+            resolve(command)
+        best = min(best, time.perf_counter() - start)
+    return len(commands) / best
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    commands = make_commands()
+    registry = MemeRegistry(ALL_MEMES)
+    trie = CharTrie()
+    for meme in ALL_MEMES:
+        for alias in meme.aliases:
+            trie[alias] = meme
+
+    start = time.perf_counter()
+    MemeRegistry(ALL_MEMES)
+    print(f'building the registry: {(time.perf_counter() - start) * 1000:.2f}ms for {len(ALL_MEMES)} memes')
+
+    resolved = sum(registry.resolve(command) is not None for command in commands)
+    raw_resolved = sum(bool(trie.longest_prefix(command.strip())) for command in commands)
+    print(f'resolved {resolved}/{len(commands)} commands, raw trie lookup {raw_resolved}/{len(commands)}')
+
+    registry_rate = throughput(registry.resolve, commands, args.repeat)
+    trie_rate = throughput(lambda command: trie.longest_prefix(command.strip()), commands, args.repeat)
+    print(f'{"registry.resolve":<20} {registry_rate:>12,.0f} lookups/s  {1e6 / registry_rate:>6.2f}us each')
+    print(f'{"raw trie":<20} {trie_rate:>12,.0f} lookups/s  {1e6 / trie_rate:>6.2f}us each')
+
+    typos = [typo(alias) + TEXT for meme in ALL_MEMES for alias in meme.aliases if len(alias) > 3]
+    suggested = sum(bool(registry.suggest(command)) for command in typos)
+    suggest_rate = throughput(registry.suggest, typos, max(1, args.repeat // 10))
+    print(f'{"registry.suggest":<20} {suggest_rate:>12,.0f} lookups/s  {1e6 / suggest_rate:>6.2f}us each '
+        f'({suggested}/{len(typos)} typos got suggestions)')
+
+
+if __name__ == '__main__':
+    run()
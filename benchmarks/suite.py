@@ -0,0 +1,231 @@
+'''Renders every meme in ALL_MEMES with short, long and url inputs and reports p50/p95
+latency, output size, throughput at increasing concurrency and peak memory.
+
+    python -m benchmarks.suite [--repeat N] [--concurrency 1,2,4] [--pool thread|process] [--json results.json]
+    python -m benchmarks.suite --compare before.json after.json
+
+Runs offline: url inputs point at generated images served from localhost (see fixtures.py).
+Latency for url inputs is measured with empty remote image caches, so every render
+downloads and decodes its image; throughput runs use the caches like the bot does.
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+import PIL
+from meme_generator import ALL_MEMES, Meme, RenderExecutor, set_decoded_image_cache, set_remote_image_cache
+from meme_generator.batch import BatchJob, render_batch
+from meme_generator.plugins import ContextInput, DrawImage, DrawInput
+from .fixtures import make_fixtures, serve_fixtures
+
+SHORT_TEXT = 'yes'
+LONG_TEXT = 'when you finally fix the bug at 3am and find out the tests were never running in the first place'
+
+
+def text_slots(meme: Meme) -> List[bool]:
+    '''One entry per `text-N` the meme reads (just one for memes taking the whole input),
+    True where that slot can be an image url'''
+    slots: Dict[int, bool] = {}
+    for plugin in meme.plugins:
+        plugin_input = plugin.plugin_input
+        if isinstance(plugin_input, ContextInput) and plugin_input.key.startswith('text-'):
+            number = int(plugin_input.key[len('text-'):])
+            slots[number] = slots.get(number, False) or isinstance(plugin, (DrawImage, DrawInput))
+    if not slots:
+        return [False]
+    return [slots.get(number, False) for number in range(1, max(slots) + 1)]
+
+
+def make_inputs(meme: Meme, image_urls: List[str]) -> Dict[str, str]:
+    '''input kind -> meme text'''
+    slots = text_slots(meme)
+    inputs = {
+        'short': ' / '.join(SHORT_TEXT for _ in slots),
+        'long': ' / '.join(LONG_TEXT for _ in slots),
+    }
+    if any(slots):
+        inputs['url'] = ' / '.join(image_urls[i % len(image_urls)] if takes_image else SHORT_TEXT
+            for i, takes_image in enumerate(slots))
+    return inputs
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_bytes(who: int) -> Optional[int]:
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+async def measure_latency(meme: Meme, text: str, repeat: int, executor: RenderExecutor, cold_images: bool) -> Dict:
+    times: List[float] = []
+    for i in range(repeat + 1):
+        if cold_images:
+            set_remote_image_cache(None)
+            set_decoded_image_cache(None)
+        start = time.perf_counter()
+        encoded = await meme.render(text, executor=executor)
+        if i > 0:  # the first render loads the template and fonts
+            times.append(time.perf_counter() - start)
+    return {
+        'p50_ms': round(percentile(times, 0.5) * 1000, 3),
+        'p95_ms': round(percentile(times, 0.95) * 1000, 3),
+        'mean_ms': round(sum(times) / len(times) * 1000, 3),
+        'format': encoded.format,
+        'bytes': len(encoded.data),
+    }
+
+
+async def measure_throughput(jobs: List[BatchJob], concurrency: int, pool: str) -> Dict:
+    executor = RenderExecutor(kind=pool, max_workers=concurrency, max_concurrency=concurrency)
+    try:
+        # one untimed pass so worker startup and template loading aren't counted
+        async for _ in render_batch(jobs[:concurrency], executor=executor):
+            pass
+        errors = 0
+        start = time.perf_counter()
+        async for result in render_batch(jobs, executor=executor):
+            errors += result.error is not None
+        elapsed = time.perf_counter() - start
+    finally:
+        executor.shutdown(wait=True)
+    return {
+        'concurrency': concurrency,
+        'renders': len(jobs),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'renders_per_second': round(len(jobs) / elapsed, 2),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_suite(args: argparse.Namespace) -> Dict:
+    memes = [meme for meme in ALL_MEMES if not args.only or meme.aliases[0] in args.only]
+    results: Dict = {
+        'meta': {
+            # before anything big is loaded, so git doesn't show up as a large child process
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'pool': args.pool,
+        },
+        'latency': {},
+        'throughput': [],
+    }
+    fixtures = make_fixtures()
+
+    async with serve_fixtures(fixtures) as base_url:
+        image_urls = [f'{base_url}/{name}' for name in fixtures]
+        inputs = {meme.aliases[0]: make_inputs(meme, image_urls) for meme in memes}
+
+        executor = RenderExecutor(kind='thread', max_workers=1)
+        try:
+            for meme in memes:
+                alias = meme.aliases[0]
+                results['latency'][alias] = {}
+                for kind, text in inputs[alias].items():
+                    latency = await measure_latency(meme, text, args.repeat, executor, cold_images=kind == 'url')
+                    results['latency'][alias][kind] = latency
+                    print(f'{alias:<22} {kind:<6} p50 {latency["p50_ms"]:>8.2f}ms  p95 {latency["p95_ms"]:>8.2f}ms  '
+                        f'{latency["bytes"]:>9} bytes {latency["format"]}', flush=True)
+        finally:
+            executor.shutdown(wait=True)
+
+        jobs = [BatchJob(f'{meme.aliases[0]}-{kind}', meme, text)
+            for meme in memes for kind, text in inputs[meme.aliases[0]].items()] * args.throughput_rounds
+        for concurrency in args.concurrency:
+            throughput = await measure_throughput(jobs, concurrency, args.pool)
+            results['throughput'].append(throughput)
+            print(f'concurrency {concurrency:>3}: {throughput["renders_per_second"]:>8.2f} renders/s '
+                f'({throughput["errors"]} errors)', flush=True)
+
+    results['peak_rss_bytes'] = peak_rss_bytes(0)  # RUSAGE_SELF
+    # render worker processes
+    results['peak_children_rss_bytes'] = peak_rss_bytes(-1) if args.pool == 'process' else None  # RUSAGE_CHILDREN
+    if results['peak_rss_bytes']:
+        print(f'peak rss: {results["peak_rss_bytes"] / (1024 * 1024):.1f} MB'
+            + (f', worker processes: {results["peak_children_rss_bytes"] / (1024 * 1024):.1f} MB'
+                if results['peak_children_rss_bytes'] else ''))
+    return results
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    print(f'{"meme":<22} {"input":<6} {"p50 before":>11} {"p50 after":>10} {"change":>8} {"bytes change":>13}')
+    for alias, kinds in after['latency'].items():
+        for kind, result in kinds.items():
+            previous = before['latency'].get(alias, {}).get(kind)
+            if previous is None:
+                continue
+            change = result['p50_ms'] / previous['p50_ms'] - 1
+            bytes_change = result['bytes'] / previous['bytes'] - 1
+            print(f'{alias:<22} {kind:<6} {previous["p50_ms"]:>9.2f}ms {result["p50_ms"]:>8.2f}ms '
+                f'{change:>+7.1%} {bytes_change:>+12.1%}')
+
+    previous_throughput = {result['concurrency']: result for result in before['throughput']}
+    for result in after['throughput']:
+        previous = previous_throughput.get(result['concurrency'])
+        if previous is not None:
+            change = result['renders_per_second'] / previous['renders_per_second'] - 1
+            print(f'concurrency {result["concurrency"]:>3}: {previous["renders_per_second"]:>8.2f} -> '
+                f'{result["renders_per_second"]:>8.2f} renders/s ({change:+.1%})')
+
+
+def default_concurrency() -> List[int]:
+    levels, level = [], 1
+    while level <= (os.cpu_count() or 1):
+        levels.append(level)
+        level *= 2
+    return levels
+
+
+def run():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='timed renders per meme and input')
+    parser.add_argument('-c', '--concurrency', type=lambda value: [int(level) for level in value.split(',')],
+        default=default_concurrency(), help='comma separated concurrency levels (default: 1, 2, 4... up to cpu count)')
+    parser.add_argument('--throughput-rounds', type=int, default=3, help='times every job is repeated in throughput runs')
+    parser.add_argument('--pool', choices=('thread', 'process'), default='thread', help='render pool for throughput runs')
+    parser.add_argument('--only', nargs='+', metavar='ALIAS', help='only benchmark these memes')
+    parser.add_argument('--json', metavar='PATH', help='write results here')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = asyncio.run(run_suite(args))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'wrote {args.json}')
+
+
+if __name__ == '__main__':
+    run()
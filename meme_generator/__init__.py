@@ -1,2 +1,21 @@
 from .meme import Meme
+from .render import render_meme
+from .animation import render_animated
+from .encoding import EncodedImage, OutputFormat, OutputPolicy, encode
+from .executor import RenderExecutor, get_render_executor, set_render_executor
+from .farm import RenderFarm
+from .batch import BatchJob, BatchResult, render_batch
+from .profiling import Profile, RenderObserver, SlowRenderLogger, Span, SpanRecorder, StageStats
+from .templates import DEFAULT_MAX_DIMENSION, TemplateCache, get_template_cache, set_template_cache
+from .fonts import FontRegistry, get_font_registry, set_font_registry
+from .fetch import FetchError, ImageFetcher, get_image_fetcher, set_image_fetcher
+from .remotecache import (DecodedImageCache, RemoteImageCache, get_decoded_image_cache, get_remote_image_cache,
+    set_decoded_image_cache, set_remote_image_cache)
+from .resultcache import RenderCache
+from .singleflight import SingleFlight
+from .plan import RenderPlan, compile_all, compile_meme, get_plan
+from .layout import LayoutCache, get_layout_cache, set_layout_cache
 from .allmemes import ALL_MEMES
+from .definitions import MemeChanges, MemeDefinitionError, MemeLibrary, load_definition_file, parse_meme
+from .registry import (MemeMatch, MemeRegistry, MemeRegistryError, get_meme_registry, normalize_alias,
+    set_meme_registry)
@@ -1,5 +1,9 @@
 from .plugins import DrawText, TrimText, SpongifyText, AutoPosition, Coordinate, SplitText, DrawImage, UserInput, RawInput, ContextInput, TextStyle, DrawInput
 from .meme import Meme
+from .encoding import OutputFormat, OutputPolicy
+
+# big templates that are slow to encode and upload as PNG
+LARGE_TEMPLATE_OUTPUT = OutputPolicy(format=OutputFormat.JPEG, quality=90, optimize=True, progressive=True)
 
 
 ALL_MEMES = [
@@ -53,13 +57,13 @@ ALL_MEMES = [
             SplitText(plugin_input=UserInput(), separator=' /'),
             DrawInput(plugin_input=ContextInput(key='text-1'), position=Coordinate(x=384, y=229),
                     maxwidth=15, fontsize=72, textstyle=TextStyle.BLACK,
-                    max_size=Coordinate(x=762, y=450)),
+                    max_size=Coordinate(x=762, y=450), autofit=True),
             DrawInput(plugin_input=ContextInput(key='text-2'), position=Coordinate(x=384, y=691),
                 maxwidth=15, fontsize=72, textstyle=TextStyle.BLACK,
-                max_size=Coordinate(x=762, y=450)),
+                max_size=Coordinate(x=762, y=450), autofit=True),
             DrawInput(plugin_input=ContextInput(key='text-3'), position=Coordinate(x=384, y=1168),
                     maxwidth=12, fontsize=72, textstyle=TextStyle.BLACK,
-                    max_size=Coordinate(x=762, y=450)),
+                    max_size=Coordinate(x=762, y=450), autofit=True),
         ]
     ),
     Meme(
@@ -105,6 +109,7 @@ ALL_MEMES = [
     ),
     Meme(
         image_filename='nut-button.jpg',
+        output=LARGE_TEMPLATE_OUTPUT,
         aliases=['nut button', 'blue button'],
         help_string='Usage: !meme nut button <text on button> / <optional: text on hand> / <optional: text above meme>',
         plugins=[
@@ -145,6 +150,7 @@ ALL_MEMES = [
     ),
     Meme(
         image_filename='fancy-winnie-the-pooh.png',
+        output=LARGE_TEMPLATE_OUTPUT,
         aliases=['fancy pooh', 'fancy winnie the pooh', 'pooh', 'fp'],
         help_string='Usage: !meme fancy pooh <top> / <bottom>',
         plugins=[
@@ -197,6 +203,7 @@ ALL_MEMES = [
     ),
     Meme(
         image_filename='always-has-been.png',
+        output=LARGE_TEMPLATE_OUTPUT,
         aliases=['always has been', 'always'],
         help_string='Usage: !meme always has been <astronaut asking> / <optional: earth>',
         plugins=[
@@ -0,0 +1,204 @@
+import io
+import logging
+import math
+import time
+from typing import TYPE_CHECKING, IO, Iterator, List, Optional, Set, Tuple
+from PIL import GifImagePlugin, Image, ImageChops, ImageSequence
+from .encoding import EncodedImage, OutputPolicy
+from .plan import get_plan, resolve_steps
+from .profiling import SpanRecorder
+from .templates import template_path, template_scale
+
+if TYPE_CHECKING:
+    from .meme import Meme
+    from .render import RenderSteps
+
+log = logging.getLogger('memebot')
+
+RGB = Tuple[int, int, int]
+Box = Tuple[int, int, int, int]
+
+# frames past this are left out, so one huge animation can't hold up a render worker
+MAX_ANIMATION_FRAMES = 500
+# used for frames that don't say how long they're shown
+DEFAULT_FRAME_DURATION = 100
+MAX_PALETTE_COLORS = 256
+
+
+class FrameUpdate:
+    '''What changed since the previous frame of an animation: the composited `region`
+    (None if nothing did) to be drawn at `offset`, how many milliseconds the frame is
+    shown, and the template's colors in the changed part (None if there are more than
+    fit in a palette)'''
+    __slots__ = ('region', 'offset', 'duration', 'colors')
+
+    def __init__(self, region: Optional[Image.Image], offset: Tuple[int, int], duration: int,
+            colors: Optional[Set[RGB]] = None):
+        self.region = region
+        self.offset = offset
+        self.duration = duration
+        self.colors = colors
+
+
+def render_animated(meme: 'Meme', steps: 'RenderSteps', policy: OutputPolicy,
+        recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+    '''`render_meme` for animated (GIF or APNG) templates, always encoded as a GIF.
+
+    Plugins draw once, onto a transparent overlay that gets composited onto every frame
+    as the template is decoded. Only the part of a frame that changed since the previous
+    one is scaled, composited and written, and frames that didn't change at all are
+    merged into the previous one. Frames go straight from the decoder to the encoder,
+    so no more than two of them are decoded at once.
+
+    GIF frames are quantized to the template's own palette, plus the overlay's colors
+    if there's room left; frames with colors of their own (and APNG frames) get a
+    palette of their own. `policy.max_dimension` applies, the rest of the policy doesn't.
+    '''
+    start = recorder.start() if recorder else None
+    scale = template_scale(meme.image_filename, policy.max_dimension)
+    plan_steps = get_plan(meme, scale).steps
+
+    with Image.open(template_path(meme.image_filename)) as template:
+        size = (max(1, round(template.size[0] * scale)), max(1, round(template.size[1] * scale)))
+        overlay = Image.new('RGBA', size, (0, 0, 0, 0))
+        if recorder:
+            recorder.record('template', start)
+
+        for index, prepared in resolve_steps(steps):
+            start = recorder.start() if recorder else None
+            plan_steps[index].draw(overlay, prepared)
+            if recorder:
+                recorder.record('draw', start, index, plan_steps[index].plugin)
+
+        start = recorder.start() if recorder else None
+        encode_start = time.perf_counter()
+        palette = None
+        if template.mode == 'P':
+            palette = _palette_colors(template.getpalette())
+            palette += _overlay_colors(overlay, MAX_PALETTE_COLORS - len(palette))
+        output = io.BytesIO()
+        frames = write_gif(output, frame_updates(template, overlay), palette, loop=template.info.get('loop', 0))
+        encoded = EncodedImage(output.getvalue(), 'GIF', time.perf_counter() - encode_start)
+        if recorder:
+            recorder.record('encode', start)
+            encoded.spans = recorder.spans
+
+    log.debug(f'encoded {meme.aliases[0]} as an animation of {frames} frames: {len(encoded.data)} bytes '
+        f'in {encoded.encode_seconds * 1000:.1f}ms')
+    return encoded
+
+
+def frame_updates(template: Image.Image, overlay: Image.Image) -> Iterator[FrameUpdate]:
+    '''Every frame of `template`, as the change from the previous one, scaled to the
+    overlay's size and with the overlay on top'''
+    scale = overlay.size[0] / template.size[0]
+    overlay_bbox = overlay.getbbox()
+    previous: Optional[Image.Image] = None
+    for number, frame in enumerate(ImageSequence.Iterator(template)):
+        if number == MAX_ANIMATION_FRAMES:
+            log.warning(f'animation has more than {MAX_ANIMATION_FRAMES} frames, leaving the rest out')
+            return
+        duration = int(frame.info.get('duration') or DEFAULT_FRAME_DURATION)
+        # a copy, the decoder reuses the frame's memory
+        source = frame.convert('RGB')
+        changed = (0, 0) + source.size if previous is None else ImageChops.difference(source, previous).getbbox()
+        previous = source
+        if changed is None:
+            yield FrameUpdate(None, (0, 0), duration)
+            continue
+
+        colors = source.crop(changed).getcolors(MAX_PALETTE_COLORS)
+        region_box = _scale_box(changed, scale, overlay.size)
+        if scale == 1:
+            region = source.crop(region_box)
+        else:
+            # scales just the changed part, matching the same part of the whole frame scaled
+            region = source.resize((region_box[2] - region_box[0], region_box[3] - region_box[1]), Image.BILINEAR,
+                box=tuple(coordinate / scale for coordinate in region_box), reducing_gap=2.0)
+        if overlay_bbox and _intersects(region_box, overlay_bbox):
+            captions = overlay.crop(region_box)
+            region.paste(captions, (0, 0), captions)
+        yield FrameUpdate(region, region_box[:2], duration, None if colors is None else set(color for _, color in colors))
+
+
+def write_gif(fp: IO[bytes], updates: Iterator[FrameUpdate], palette: Optional[List[RGB]] = None, loop: int = 0) -> int:
+    '''Encodes frames as they come, holding on to the last one to add the duration of
+    updates that didn't change anything. The first update has to be the whole frame.
+    Updates whose colors are all in `palette` use it, others get their own.
+    Returns the number of frames written.'''
+    palette_image = _palette_image(palette) if palette else None
+    palette_set = set(palette or ())
+    # frame waiting to be written: (quantized region, offset, duration, whether it has its own palette)
+    pending: Optional[Tuple[Image.Image, Tuple[int, int], int, bool]] = None
+    written = 0
+
+    for update in updates:
+        if update.region is None:
+            pending = pending[:2] + (pending[2] + update.duration, pending[3])
+            continue
+        if palette_image is not None and update.colors is not None and update.colors <= palette_set:
+            quantized, local_palette = update.region.quantize(palette=palette_image, dither=Image.Dither.NONE), False
+        else:
+            quantized, local_palette = update.region.quantize(MAX_PALETTE_COLORS, method=Image.Quantize.MEDIANCUT), True
+
+        if pending is None:
+            header_image = palette_image if palette_image is not None else quantized
+            for block in GifImagePlugin.getheader(header_image, info=dict(loop=loop))[0]:
+                fp.write(block)
+            local_palette = local_palette and palette_image is not None
+        else:
+            _write_frame(fp, *pending)
+            written += 1
+        pending = (quantized, update.offset, update.duration, local_palette)
+
+    if pending is not None:
+        _write_frame(fp, *pending)
+        written += 1
+    fp.write(b';')
+    return written
+
+
+def _scale_box(box: Box, scale: float, size: Tuple[int, int]) -> Box:
+    '''`box` scaled, grown by a pixel for what the filter blends in from around it'''
+    if scale == 1:
+        return box
+    return (max(0, math.floor(box[0] * scale) - 1), max(0, math.floor(box[1] * scale) - 1),
+        min(size[0], math.ceil(box[2] * scale) + 1), min(size[1], math.ceil(box[3] * scale) + 1))
+
+
+def _intersects(a: Box, b: Box) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def _palette_colors(palette: List[int]) -> List[RGB]:
+    colors = []
+    for color in zip(palette[0::3], palette[1::3], palette[2::3]):
+        if color not in colors:
+            colors.append(color)
+    return colors[:MAX_PALETTE_COLORS]
+
+
+def _overlay_colors(overlay: Image.Image, count: int) -> List[RGB]:
+    '''Up to `count` colors the overlay (the captions) is drawn in'''
+    bbox = overlay.getbbox()
+    if count <= 0 or bbox is None:
+        return []
+    region = overlay.crop(bbox)
+    opaque = Image.new('RGB', region.size)
+    opaque.paste(region, mask=region.getchannel('A').point(lambda alpha: 255 if alpha == 255 else 0))
+    colors = opaque.quantize(min(count, MAX_PALETTE_COLORS), method=Image.Quantize.MEDIANCUT)
+    return _palette_colors(colors.getpalette()[:3 * len(colors.getcolors())])
+
+
+def _palette_image(palette: List[RGB]) -> Image.Image:
+    '''P image carrying `palette`, for frames to be quantized to'''
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette([channel for color in palette for channel in color])
+    return palette_image
+
+
+def _write_frame(fp: IO[bytes], frame: Image.Image, offset: Tuple[int, int], duration: int, local_palette: bool):
+    # disposal 1 leaves the frame in place for the next (partial) frame to be drawn over
+    for block in GifImagePlugin.getdata(frame, offset, duration=duration, disposal=1,
+            include_color_table=local_palette):
+        fp.write(block)
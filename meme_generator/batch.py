@@ -0,0 +1,88 @@
+import asyncio
+import itertools
+import logging
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set
+from .encoding import EncodedImage, OutputPolicy
+from .executor import RenderExecutor, get_render_executor
+from .meme import Meme
+
+log = logging.getLogger('memebot')
+
+
+class BatchJob:
+    '''One meme to render in a batch. `id` is only there to tell results apart.'''
+    __slots__ = ('id', 'meme', 'text')
+
+    def __init__(self, id: str, meme: Meme, text: str):
+        self.id = id
+        self.meme = meme
+        self.text = text
+
+    def __repr__(self):
+        return f'BatchJob(id={self.id!r}, meme={self.meme.aliases[0]!r}, text={self.text!r})'
+
+
+class BatchResult:
+    '''Either `encoded` or `error` is set'''
+    __slots__ = ('job', 'encoded', 'error', 'seconds')
+
+    def __init__(self, job: BatchJob, encoded: Optional[EncodedImage] = None,
+            error: Optional[BaseException] = None, seconds: float = 0.0):
+        self.job = job
+        self.encoded = encoded
+        self.error = error
+        self.seconds = seconds
+
+
+def group_by_template(jobs: Iterable[BatchJob]) -> List[BatchJob]:
+    '''Jobs reordered so ones using the same template are next to each other, in order
+    of each template's first appearance. Rendering them together means a template gets
+    decoded once and stays in the template cache while it's needed.'''
+    groups: Dict[str, List[BatchJob]] = {}
+    for job in jobs:
+        groups.setdefault(job.meme.image_filename, []).append(job)
+    return list(itertools.chain.from_iterable(groups.values()))
+
+
+async def render_batch(jobs: Iterable[BatchJob], *, executor: Optional[RenderExecutor] = None,
+        policy: Optional[OutputPolicy] = None, max_pending: Optional[int] = None) -> AsyncIterator[BatchResult]:
+    '''Renders every job on `executor`, yielding results as they finish (not in job order).
+
+    Jobs are grouped by template first. At most `max_pending` jobs (twice the executor's
+    concurrency by default) are in flight at once, so a large batch doesn't queue
+    everything up front. A failing job is reported in its result instead of stopping
+    the batch.
+    '''
+    executor = executor or get_render_executor()
+    max_pending = max_pending or executor.max_concurrency * 2
+    queue = iter(group_by_template(jobs))
+    pending: Set[asyncio.Future] = set()
+    # image_filename -> loading that template, shared by every job using it
+    warming: Dict[str, asyncio.Future] = {}
+
+    async def render(job: BatchJob) -> BatchResult:
+        start = time.perf_counter()
+        try:
+            warm = warming.get(job.meme.image_filename)
+            if warm is None:
+                warm = warming[job.meme.image_filename] = asyncio.ensure_future(executor.warm([job.meme], policy))
+            await asyncio.shield(warm)
+            encoded = await job.meme.render(job.text, executor=executor, policy=policy)
+        except Exception as e:
+            log.debug(f'batch job {job.id} failed', exc_info=True)
+            return BatchResult(job, error=e, seconds=time.perf_counter() - start)
+        return BatchResult(job, encoded=encoded, seconds=time.perf_counter() - start)
+
+    try:
+        while True:
+            for job in itertools.islice(queue, max_pending - len(pending)):
+                pending.add(asyncio.ensure_future(render(job)))
+            if not pending:
+                return
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,247 @@
+import enum
+import json
+import logging
+import os
+import threading
+import tomllib
+from typing import Any, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel, ValidationError
+from .meme import Meme
+from .plugins import (BasePlugin, ContextInput, DrawImage, DrawInput, DrawText, RawInput, SplitText, SpongifyText,
+    TrimText, UserInput)
+from .plugins.input import AbstractInput
+from .resultcache import forget_template_version
+from .templates import forget_template
+
+log = logging.getLogger('memebot')
+
+DEFINITION_EXTENSIONS = ('.yaml', '.yml', '.json', '.toml')
+
+# `type` names usable in definition files
+PLUGIN_TYPES: Dict[str, Type[BasePlugin]] = {plugin_type.__name__: plugin_type
+    for plugin_type in (DrawText, DrawImage, DrawInput, SpongifyText, TrimText, SplitText)}
+INPUT_TYPES: Dict[str, Type[AbstractInput]] = {input_type.__name__: input_type
+    for input_type in (UserInput, RawInput, ContextInput)}
+
+
+class MemeDefinitionError(ValueError):
+    pass
+
+
+def parse_meme(data: Dict[str, Any], base_dir: Optional[str] = None) -> Meme:
+    '''Builds a meme from its data file form: the `Meme` fields, with every plugin and
+    plugin input given as a mapping with a `type` (the class name) next to its fields.
+    Enum fields take member names (`textstyle: BLACK`).
+
+    A relative `image_filename` that exists next to the definition file (in `base_dir`)
+    is used from there, anything else is looked up in the bundled templates.'''
+    data = dict(data)
+    try:
+        data['plugins'] = [_parse_model(plugin, PLUGIN_TYPES, 'plugin') for plugin in data.get('plugins', [])]
+    except (TypeError, AttributeError) as e:
+        raise MemeDefinitionError(f'plugins must be a list of mappings: {e}')
+    image_filename = data.get('image_filename')
+    if base_dir and isinstance(image_filename, str) and not os.path.isabs(image_filename):
+        local_path = os.path.join(base_dir, image_filename)
+        if os.path.exists(local_path):
+            data['image_filename'] = os.path.abspath(local_path)
+    try:
+        return Meme(**data)
+    except ValidationError as e:
+        raise MemeDefinitionError(f'invalid meme {data.get("aliases")}: {e}')
+
+
+def _parse_model(data: Dict[str, Any], types: Dict[str, Type[BaseModel]], kind: str) -> BaseModel:
+    data = dict(data)
+    type_name = data.pop('type', None)
+    model_type = types.get(type_name)
+    if model_type is None:
+        raise MemeDefinitionError(f'unknown {kind} type {type_name!r}, expected one of {sorted(types)}')
+    if isinstance(data.get('plugin_input'), dict):
+        data['plugin_input'] = _parse_model(data['plugin_input'], INPUT_TYPES, 'input')
+    for name, value in data.items():
+        field = model_type.model_fields.get(name)
+        annotation = field.annotation if field else None
+        if isinstance(annotation, type) and issubclass(annotation, enum.Enum) and isinstance(value, str):
+            if value.upper() in annotation.__members__:
+                data[name] = annotation[value.upper()]
+    try:
+        return model_type(**data)
+    except ValidationError as e:
+        raise MemeDefinitionError(f'invalid {type_name}: {e}')
+
+
+def read_definition_file(path: str) -> List[Dict[str, Any]]:
+    '''The raw meme definitions in a file: either a single meme, a list of memes,
+    or a mapping with a `memes` list (the only option in TOML, as `[[memes]]`)'''
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        if extension in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise MemeDefinitionError(f'{path}: reading yaml meme definitions needs pyyaml installed')
+            try:
+                data = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise MemeDefinitionError(f'{path}: {e}')
+        elif extension == '.toml':
+            data = tomllib.load(f)
+        elif extension == '.json':
+            data = json.load(f)
+        else:
+            raise MemeDefinitionError(f'{path}: unknown meme definition format, expected one of {DEFINITION_EXTENSIONS}')
+    if isinstance(data, dict):
+        data = data['memes'] if 'memes' in data else [data]
+    if not isinstance(data, list) or not all(isinstance(meme, dict) for meme in data):
+        raise MemeDefinitionError(f'{path}: expected a meme, a list of memes or a mapping with a memes list')
+    return data
+
+
+def load_definition_file(path: str) -> List[Meme]:
+    try:
+        definitions = read_definition_file(path)
+    except (OSError, ValueError) as e:  # json and toml errors are ValueErrors
+        raise MemeDefinitionError(f'could not read {path}: {e}')
+    base_dir = os.path.dirname(os.path.abspath(path))
+    memes = []
+    for definition in definitions:
+        try:
+            memes.append(parse_meme(definition, base_dir))
+        except MemeDefinitionError as e:
+            raise MemeDefinitionError(f'{path}: {e}')
+    return memes
+
+
+class MemeChanges:
+    '''What a `MemeLibrary.reload` changed. A meme whose definition changed is in both
+    lists: the old object in `removed` and its replacement in `added`.'''
+    __slots__ = ('added', 'removed')
+
+    def __init__(self, added: Optional[List[Meme]] = None, removed: Optional[List[Meme]] = None):
+        self.added = added or []
+        self.removed = removed or []
+
+    def __bool__(self):
+        return bool(self.added or self.removed)
+
+    def __repr__(self):
+        return (f'MemeChanges(added={[meme.aliases[0] for meme in self.added]}, '
+            f'removed={[meme.aliases[0] for meme in self.removed]})')
+
+
+# (st_mtime_ns, st_size) of a file, to tell whether it changed
+FileVersion = Tuple[int, int]
+
+
+class _LoadedFile:
+    __slots__ = ('version', 'memes', 'templates')
+
+    def __init__(self, version: FileVersion, memes: List[Meme], templates: Dict[str, FileVersion]):
+        self.version = version
+        self.memes = memes
+        # versions of templates that live next to the definitions, so editing an image reloads its memes
+        self.templates = templates
+
+
+class MemeLibrary:
+    '''Memes defined in the data files in `directory` (see `parse_meme` for the format).
+
+    Nothing is read until the first `reload`, and templates are only decoded once a
+    meme is rendered. Each `reload` only parses files that changed since the last one
+    and reports which memes came and went, keeping the same objects for memes whose
+    definition didn't change so their caches and render plans stay valid. A file that
+    fails to load keeps its previous memes, so a typo doesn't take them offline.
+
+    Template caches of process pool workers aren't reached from here: a template image
+    edited in place is picked up by workers once they get replaced.
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: Dict[str, _LoadedFile] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'MemeLibrary(directory={self.directory!r}, memes={len(self.memes)})'
+
+    @property
+    def memes(self) -> List[Meme]:
+        return [meme for path in sorted(self._files) for meme in self._files[path].memes]
+
+    def reload(self) -> MemeChanges:
+        with self._lock:
+            return self._reload()
+
+    def _reload(self) -> MemeChanges:
+        changes = MemeChanges()
+        paths = self._scan()
+        for path in list(self._files):
+            if path not in paths:
+                log.info(f'meme definitions {path} removed')
+                changes.removed.extend(self._files.pop(path).memes)
+
+        for path, version in paths.items():
+            loaded = self._files.get(path)
+            if loaded is not None and loaded.version == version and self._templates_unchanged(loaded):
+                continue
+            try:
+                memes = load_definition_file(path)
+            except MemeDefinitionError:
+                log.exception(f'could not load meme definitions from {path}')
+                continue
+            templates = {meme.image_filename: _file_version(meme.image_filename)
+                for meme in memes if os.path.isabs(meme.image_filename)}
+            previous = loaded.memes if loaded is not None else []
+            self._files[path] = _LoadedFile(version, self._diff(previous, memes, loaded, templates, changes), templates)
+            log.info(f'loaded {len(memes)} memes from {path}')
+        return changes
+
+    def _scan(self) -> Dict[str, FileVersion]:
+        paths = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            log.warning(f'could not read meme definition directory {self.directory}', exc_info=True)
+            return {path: loaded.version for path, loaded in self._files.items()}
+        for entry in entries:
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in DEFINITION_EXTENSIONS:
+                stat = entry.stat()
+                paths[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return paths
+
+    def _templates_unchanged(self, loaded: _LoadedFile) -> bool:
+        return all(_file_version(path) == version for path, version in loaded.templates.items())
+
+    def _diff(self, previous: List[Meme], memes: List[Meme], loaded: Optional[_LoadedFile],
+            templates: Dict[str, FileVersion], changes: MemeChanges) -> List[Meme]:
+        '''`memes` with unchanged ones swapped for the objects already in use'''
+        changed_templates = set(path for path, version in templates.items()
+            if loaded is None or loaded.templates.get(path) != version)
+        for path in changed_templates:
+            forget_template(path)
+            forget_template_version(path)
+
+        unchanged = {}
+        for meme in previous:
+            unchanged[meme.aliases[0]] = meme
+        result = []
+        for meme in memes:
+            old = unchanged.pop(meme.aliases[0], None)
+            if old is not None and old == meme and meme.image_filename not in changed_templates:
+                result.append(old)
+                continue
+            if old is not None:
+                changes.removed.append(old)
+            changes.added.append(meme)
+            result.append(meme)
+        changes.removed.extend(unchanged.values())
+        return result
+
+
+def _file_version(path: str) -> FileVersion:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return (0, 0)
+    return (stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,169 @@
+import enum
+import io
+import logging
+import time
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel
+from PIL import Image
+from .profiling import Span
+from .templates import DEFAULT_MAX_DIMENSION
+
+log = logging.getLogger('memebot')
+
+# lowest quality and smallest scale tried when squeezing an image under `OutputPolicy.max_bytes`
+MIN_FIT_QUALITY = 30
+MIN_FIT_SCALE = 0.25
+MAX_FIT_ATTEMPTS = 8
+
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
+
+class OutputFormat(str, enum.Enum):
+    ORIGINAL = 'original'  # whatever format the template is in
+    JPEG = 'jpeg'
+    PNG = 'png'
+    WEBP = 'webp'
+
+
+class OutputPolicy(BaseModel):
+    '''How a rendered meme gets encoded. Options left as None use Pillow's defaults.
+
+    Templates are rendered on a tier scaled down to fit in `max_dimension` pixels
+    (None renders at the authored size). With `max_bytes`, lossy formats lower their
+    quality (down to MIN_FIT_QUALITY) and, if that isn't enough, every format is
+    downscaled until the output fits.
+    '''
+    format: OutputFormat = OutputFormat.ORIGINAL
+    quality: Optional[int] = None  # JPEG and WebP
+    optimize: bool = False  # JPEG and PNG
+    progressive: bool = False  # JPEG
+    png_compress_level: Optional[int] = None  # 0 (fast) to 9 (small)
+    webp_method: Optional[int] = None  # 0 (fast) to 6 (small)
+    lossless: bool = False  # WebP
+    max_bytes: Optional[int] = None
+    max_dimension: Optional[int] = DEFAULT_MAX_DIMENSION
+
+    def pillow_format(self, image: Image.Image) -> str:
+        if self.format == OutputFormat.ORIGINAL:
+            return image.format or 'PNG'
+        return self.format.name
+
+    def save_options(self, pillow_format: str, quality: Optional[int] = None) -> Dict[str, Any]:
+        quality = quality or self.quality
+        options: Dict[str, Any] = {}
+        if pillow_format == 'JPEG':
+            if quality:
+                options['quality'] = quality
+            if self.optimize:
+                options['optimize'] = True
+            if self.progressive:
+                options['progressive'] = True
+        elif pillow_format == 'PNG':
+            if self.png_compress_level is not None:
+                options['compress_level'] = self.png_compress_level
+            if self.optimize:
+                options['optimize'] = True
+        elif pillow_format == 'WEBP':
+            if quality:
+                options['quality'] = quality
+            if self.webp_method is not None:
+                options['method'] = self.webp_method
+            if self.lossless:
+                options['lossless'] = True
+        return options
+
+
+DEFAULT_POLICY = OutputPolicy()
+
+
+class EncodedImage:
+    '''An encoded render along with how long encoding took, and for profiled renders
+    the spans recorded while rendering'''
+    __slots__ = ('data', 'format', 'encode_seconds', 'spans')
+
+    def __init__(self, data: bytes, format: str, encode_seconds: float = 0.0, spans: Optional[List[Span]] = None):
+        self.data = data
+        self.format = format
+        self.encode_seconds = encode_seconds
+        self.spans = spans
+
+    def __repr__(self):
+        return f'EncodedImage(format={self.format!r}, size={len(self.data)}, encode_seconds={self.encode_seconds:.4f})'
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.format, self.format.lower())
+
+
+def encode(image: Image.Image, policy: OutputPolicy = DEFAULT_POLICY) -> EncodedImage:
+    start = time.perf_counter()
+    pillow_format = policy.pillow_format(image)
+    if pillow_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')
+
+    data = _save(image, pillow_format, policy.save_options(pillow_format))
+    if policy.max_bytes and len(data) > policy.max_bytes:
+        data = _fit(image, pillow_format, policy, data)
+
+    return EncodedImage(data, pillow_format, time.perf_counter() - start)
+
+
+def sniff_format(data: bytes) -> str:
+    '''Pillow format name of already encoded image data, judging by its header'''
+    if data.startswith(b'\xff\xd8'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG'):
+        return 'PNG'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    if data.startswith(b'GIF8'):
+        return 'GIF'
+    with Image.open(io.BytesIO(data)) as image:
+        return image.format
+
+
+def _save(image: Image.Image, pillow_format: str, options: Dict[str, Any]) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format=pillow_format, **options)
+    return output.getvalue()
+
+
+def _fit(image: Image.Image, pillow_format: str, policy: OutputPolicy, data: bytes) -> bytes:
+    '''Re-encode at lower quality, then smaller size, until the result is under `policy.max_bytes`.
+    Gives up after MAX_FIT_ATTEMPTS encodes and returns the smallest attempt.'''
+    max_bytes = policy.max_bytes
+    attempts = 0
+    best = data
+
+    if pillow_format in ('JPEG', 'WEBP') and not policy.lossless:
+        # binary search for the highest quality that fits
+        low, high = MIN_FIT_QUALITY, (policy.quality or 75) - 1
+        while low <= high and attempts < MAX_FIT_ATTEMPTS // 2:
+            quality = (low + high) // 2
+            attempt = _save(image, pillow_format, policy.save_options(pillow_format, quality))
+            attempts += 1
+            if len(attempt) <= max_bytes:
+                best, low = attempt, quality + 1
+            else:
+                high = quality - 1
+            if len(attempt) < len(best):
+                best = attempt
+        if len(best) <= max_bytes:
+            return best
+        options = policy.save_options(pillow_format, MIN_FIT_QUALITY)
+    else:
+        options = policy.save_options(pillow_format)
+
+    # encoded size roughly scales with pixel count
+    scale = 1.0
+    while len(best) > max_bytes and attempts < MAX_FIT_ATTEMPTS and scale > MIN_FIT_SCALE:
+        scale = max(MIN_FIT_SCALE, scale * (max_bytes / len(best)) ** 0.5 * 0.95)
+        size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+        attempt = _save(image.resize(size, Image.LANCZOS), pillow_format, options)
+        attempts += 1
+        if len(attempt) < len(best):
+            best = attempt
+
+    if len(best) > max_bytes:
+        log.warning(f'could not encode {image.size} {pillow_format} under {max_bytes} bytes, got {len(best)}')
+    return best
@@ -0,0 +1,167 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, Set, Tuple, TypeVar
+from .fonts import get_font_registry
+from .encoding import DEFAULT_POLICY, EncodedImage, OutputPolicy
+from .profiling import SpanRecorder
+from .render import RenderSteps, render_meme
+from .templates import get_template_cache, template_is_animated, template_scale
+
+if TYPE_CHECKING:
+    from .meme import Meme
+
+log = logging.getLogger('memebot')
+
+T = TypeVar('T')
+
+POOL_KINDS = ('thread', 'process')
+# seconds render threads wait for each other while loading fonts in `RenderExecutor.warm`
+FONT_WARMUP_TIMEOUT = 5
+
+
+class RenderExecutor:
+    '''Runs CPU-bound rendering work off of the event loop.
+
+    `kind` picks between a thread pool and a process pool. At most
+    `max_concurrency` jobs are handed to the pool at once; the rest wait on
+    the event loop, where cancelling them is free. Cancelling a job that was
+    already handed off only drops it if a worker has not picked it up yet.
+
+    Renders can start in a thread before the images they draw are downloaded (see
+    `Meme.render`), waiting for them in the worker. To keep slow downloads from tying
+    up every worker, at most `max_waiting_renders` do that at once.
+    '''
+
+    def __init__(self, kind: str = 'thread', max_workers: Optional[int] = None,
+            max_concurrency: Optional[int] = None, timeout: Optional[float] = None):
+        if kind not in POOL_KINDS:
+            raise ValueError(f'Unknown render pool kind: {kind}, expected one of {POOL_KINDS}')
+        self.kind = kind
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_concurrency = max_concurrency or self.max_workers * 2
+        self.timeout = timeout
+        self.max_waiting_renders = self.max_workers // 2 if kind == 'thread' else 0
+        self.waiting_renders = 0
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._pool: Optional[concurrent.futures.Executor] = None
+
+    def __repr__(self):
+        return (f'{type(self).__name__}(kind={self.kind!r}, max_workers={self.max_workers}, '
+            f'max_concurrency={self.max_concurrency}, timeout={self.timeout})')
+
+    @property
+    def pool(self) -> concurrent.futures.Executor:
+        if self._pool is None:
+            self._pool = self._create_pool()
+        return self._pool
+
+    def _create_pool(self) -> concurrent.futures.Executor:
+        if self.kind == 'process':
+            return concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+        return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='meme-render')
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        '''Run `func(*args)` in the pool and wait for the result.
+
+        With a process pool, `func` and `args` must be picklable.
+        '''
+        loop = asyncio.get_running_loop()
+        await self._semaphore.acquire()
+        try:
+            pool_future = self.pool.submit(func, *args)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+        # the slot is only given back once the pool is done with the job, even if
+        # the caller gave up on it earlier, so a timed out render can't overcommit the pool
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self._semaphore.release)
+            except RuntimeError:  # loop already closed
+                pass
+        pool_future.add_done_callback(release)
+
+        return await asyncio.wait_for(asyncio.wrap_future(pool_future), self.timeout)
+
+    async def render(self, meme: 'Meme', steps: RenderSteps, policy: OutputPolicy = DEFAULT_POLICY,
+            recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+        return await self.run(render_meme, meme, steps, policy, recorder)
+
+    def reserve_waiting_render(self) -> bool:
+        '''Whether a render may be started before its downloads are done, if so it has to
+        be given back with `release_waiting_render` once they are'''
+        if self.waiting_renders >= self.max_waiting_renders:
+            return False
+        self.waiting_renders += 1
+        return True
+
+    def release_waiting_render(self):
+        self.waiting_renders -= 1
+
+    async def warm(self, memes: Iterable['Meme'], policy: Optional[OutputPolicy] = None):
+        '''Decode templates and load fonts ahead of the first render. Worker processes of
+        a plain process pool come and go with their own caches, so this only applies to threads.
+        Fonts are loaded per thread (see `FontRegistry`), so every thread of the pool loads them.'''
+        if self.kind == 'thread':
+            memes = list(memes)
+            await self.run(warm_caches, memes, policy)
+            threads = min(self.max_workers, self.max_concurrency)
+            if threads > 1:
+                barrier = threading.Barrier(threads, timeout=FONT_WARMUP_TIMEOUT)
+                fonts = meme_fonts(memes, policy)
+                await asyncio.gather(*(self.run(preload_fonts, fonts, barrier) for _ in range(threads)))
+
+    def shutdown(self, wait: bool = False):
+        if self._pool is not None:
+            log.debug(f'shutting down {self!r}')
+            self._pool.shutdown(wait=wait, cancel_futures=True)
+            self._pool = None
+
+
+def warm_caches(memes: List['Meme'], policy: Optional[OutputPolicy] = None):
+    '''Loads the template tier and fonts each meme renders with under `policy`
+    (with the meme's own output options on top)'''
+    template_cache = get_template_cache()
+    for meme in memes:
+        if not template_is_animated(meme.image_filename):  # animations are streamed, not cached
+            template_cache.warm([meme.image_filename], meme.output_policy(policy).max_dimension)
+    get_font_registry().preload(meme_fonts(memes, policy))
+    log.debug(f'warmed template cache: {len(template_cache)} templates, {template_cache.nbytes} bytes')
+
+
+def meme_fonts(memes: Iterable['Meme'], policy: Optional[OutputPolicy] = None) -> Set[Tuple[str, int]]:
+    '''(font, size) pairs the memes draw text with under `policy`'''
+    fonts: Set[Tuple[str, int]] = set()
+    for meme in memes:
+        fonts |= meme.fonts(template_scale(meme.image_filename, meme.output_policy(policy).max_dimension))
+    return fonts
+
+
+def preload_fonts(fonts: Set[Tuple[str, int]], barrier: threading.Barrier):
+    '''Loads `fonts` for this thread, then waits for the other threads of the pool to get
+    to it too, so that each of them runs one of these jobs'''
+    get_font_registry().preload(fonts)
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        log.debug('render threads were busy, some of them load their fonts on first render instead')
+
+
+_default_executor: Optional[RenderExecutor] = None
+
+
+def get_render_executor() -> RenderExecutor:
+    '''Executor used by `Meme.generate` when none is given'''
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = RenderExecutor()
+    return _default_executor
+
+
+def set_render_executor(executor: Optional[RenderExecutor]):
+    global _default_executor
+    _default_executor = executor
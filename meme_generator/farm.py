@@ -0,0 +1,137 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Optional, Union
+from .encoding import DEFAULT_POLICY, EncodedImage, OutputPolicy
+from .executor import RenderExecutor, warm_caches
+from .plan import compile_all
+from .meme import Meme
+from .profiling import SpanRecorder
+from .render import RenderSteps, render_meme
+from .templates import DEFAULT_MAX_BYTES, TemplateCache, set_template_cache
+
+log = logging.getLogger('memebot')
+
+# alias -> meme, only populated inside of farm worker processes
+_worker_memes: Dict[str, Meme] = {}
+
+
+def _init_worker(template_cache_bytes: int):
+    from .allmemes import ALL_MEMES
+    for meme in ALL_MEMES:
+        _worker_memes[meme.aliases[0]] = meme
+    set_template_cache(TemplateCache(max_bytes=template_cache_bytes))
+    warm_caches(ALL_MEMES)
+    compile_all(ALL_MEMES)
+    log.debug(f'render farm worker {os.getpid()} ready with {len(_worker_memes)} memes')
+
+
+def _render_in_worker(meme: Union[str, Meme], steps: RenderSteps, policy: OutputPolicy,
+        recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+    if isinstance(meme, str):
+        meme = _worker_memes[meme]
+    return render_meme(meme, steps, policy, recorder)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class RenderFarm(RenderExecutor):
+    '''Process pool where each worker has already decoded every template in `ALL_MEMES`
+    and loaded every font they use.
+
+    Built in memes are sent to workers by alias, so only the prepared steps get pickled.
+    Workers are replaced after `max_jobs_per_worker` renders to cap memory growth. While
+    the pool is broken, timing out or failing health checks, renders fall back to
+    `fallback` (a single render thread in this process by default).
+    '''
+
+    def __init__(self, max_workers: Optional[int] = None, max_concurrency: Optional[int] = None,
+            timeout: Optional[float] = 30, max_jobs_per_worker: Optional[int] = 200,
+            health_check_timeout: float = 10, fallback: Optional[RenderExecutor] = None,
+            template_cache_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__(kind='process', max_workers=max_workers, max_concurrency=max_concurrency, timeout=timeout)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.health_check_timeout = health_check_timeout
+        self.template_cache_bytes = template_cache_bytes
+        self.fallback = fallback or RenderExecutor(kind='thread', max_workers=1)
+        self.healthy = True
+        self._health_check_task: Optional[asyncio.Task] = None
+        from .allmemes import ALL_MEMES
+        self._builtin_memes = {meme.aliases[0]: meme for meme in ALL_MEMES}
+
+    def _create_pool(self) -> concurrent.futures.Executor:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            initializer=_init_worker,
+            initargs=(self.template_cache_bytes,),
+            max_tasks_per_child=self.max_jobs_per_worker)
+
+    async def render(self, meme: Meme, steps: RenderSteps, policy: OutputPolicy = DEFAULT_POLICY,
+            recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+        if not self.healthy:
+            return await self.fallback.render(meme, steps, policy, recorder)
+
+        alias = meme.aliases[0]
+        job = alias if self._builtin_memes.get(alias) is meme else meme
+        try:
+            return await self.run(_render_in_worker, job, steps, policy, recorder)
+        except BrokenProcessPool:
+            log.exception('render farm pool broke, rendering in process')
+            self._restart_pool()
+        except asyncio.TimeoutError:
+            # a worker dying at the wrong time can leave its job hanging without breaking the pool
+            log.warning(f'render farm timed out rendering {alias}, rendering in process')
+            self.healthy = False
+            self._restart_pool()
+        return await self.fallback.render(meme, steps, policy, recorder)
+
+    async def warm(self, memes: Iterable[Meme], policy: Optional[OutputPolicy] = None):
+        # workers already warm their caches on startup
+        pass
+
+    async def check_health(self) -> bool:
+        '''Pings the pool with a job per worker, restarting it if they aren't all answered
+        in time. Whichever workers are free answer them, so one stuck worker can still pass
+        as long as the others keep up; renders of its jobs time out instead (see `render`).
+        Pings count as jobs towards `max_jobs_per_worker`.'''
+        loop = asyncio.get_running_loop()
+        try:
+            pings = [loop.run_in_executor(self.pool, _ping) for _ in range(self.max_workers)]
+            await asyncio.wait_for(asyncio.gather(*pings), self.health_check_timeout)
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            log.warning(f'render farm failed health check, restarting pool')
+            self.healthy = False
+            self._restart_pool()
+        else:
+            if not self.healthy:
+                log.info('render farm healthy again')
+            self.healthy = True
+        return self.healthy
+
+    def start_health_checks(self, interval: float = 60):
+        async def health_check_loop():
+            while True:
+                await self.check_health()
+                await asyncio.sleep(interval)
+        if self._health_check_task is None:
+            self._health_check_task = asyncio.create_task(health_check_loop())
+
+    def _restart_pool(self):
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            # workers of a pool we gave up on might be stuck, make sure they go away
+            # so the pool's management thread can finish
+            for process in list((getattr(pool, '_processes', None) or {}).values()):
+                process.terminate()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait: bool = False):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        super().shutdown(wait=wait)
+        self.fallback.shutdown(wait=wait)
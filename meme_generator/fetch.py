@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+import aiohttp
+
+log = logging.getLogger('memebot')
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# enough of the body to tell what kind of file it is
+SNIFF_BYTES = 12
+
+# magic numbers of the formats Pillow is expected to open from user urls
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+    b'II*\x00',  # TIFF, little endian
+    b'MM\x00*',  # TIFF, big endian
+)
+
+
+class FetchError(ValueError):
+    pass
+
+
+def looks_like_image(head: bytes) -> bool:
+    '''checks the first bytes of a download against known image signatures'''
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return head.startswith(IMAGE_SIGNATURES)
+
+
+class FetchedImage:
+    '''A downloaded image and the validators to check later whether it changed'''
+    __slots__ = ('data', 'etag', 'last_modified')
+
+    def __init__(self, data: bytes, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class ImageFetcher:
+    '''Downloads user images over one long lived aiohttp session, so connections are
+    kept alive and DNS lookups are cached between renders.
+
+    Bodies are streamed and the download is aborted as soon as it goes over
+    `max_bytes` (or the server announces a bigger Content-Length), when the first
+    bytes don't look like an image, or when the connect/read timeouts run out.
+    '''
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, connect_timeout: float = 5,
+            read_timeout: float = 10, total_timeout: float = 30, max_connections: int = 32,
+            dns_cache_seconds: int = 300):
+        self.max_bytes = max_bytes
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.max_connections = max_connections
+        self.dns_cache_seconds = dns_cache_seconds
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        '''Session for the running loop. Sessions can't move between loops, so one is
+        created per loop (in practice, once).'''
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=self.dns_cache_seconds)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                headers={'Accept': 'image/*'})
+            self._loop = loop
+        return self._session
+
+    async def fetch(self, url: str) -> bytes:
+        fetched = await self.fetch_conditional(url)
+        assert fetched is not None
+        return fetched.data
+
+    async def fetch_conditional(self, url: str, etag: Optional[str] = None,
+            last_modified: Optional[str] = None) -> Optional[FetchedImage]:
+        '''Conditional GET with the validators of a copy we already have. Returns None
+        if the server says that copy is still current.'''
+        headers: Dict[str, str] = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 304 and headers:
+                    return None
+                if response.status != 200:
+                    raise FetchError(f'Could not download image, got HTTP {response.status}')
+                if response.content_length is not None and response.content_length > self.max_bytes:
+                    raise FetchError(f'Image is too big ({response.content_length} bytes)')
+                data = await self._read(response)
+                return FetchedImage(data, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        except asyncio.TimeoutError:
+            raise FetchError('Timed out downloading image')
+        except aiohttp.ClientError as e:
+            raise FetchError(f'Could not download image: {e}') from e
+
+    async def _read(self, response: aiohttp.ClientResponse) -> bytes:
+        body = bytearray()
+        sniffed = False
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body += chunk
+            if len(body) > self.max_bytes:
+                raise FetchError(f'Image is too big (over {self.max_bytes} bytes)')
+            if not sniffed and len(body) >= SNIFF_BYTES:
+                self._sniff(body, response)
+                sniffed = True
+        if not sniffed:
+            self._sniff(body, response)
+        return bytes(body)
+
+    def _sniff(self, head: bytes, response: aiohttp.ClientResponse):
+        # the content type header is often missing or wrong, so judge by the bytes
+        if not looks_like_image(head):
+            raise FetchError(f'Not an image ({response.content_type})')
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_image_fetcher: Optional[ImageFetcher] = None
+
+
+def get_image_fetcher() -> ImageFetcher:
+    global _image_fetcher
+    if _image_fetcher is None:
+        _image_fetcher = ImageFetcher()
+    return _image_fetcher
+
+
+def set_image_fetcher(fetcher: Optional[ImageFetcher]):
+    global _image_fetcher
+    _image_fetcher = fetcher
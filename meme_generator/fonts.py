@@ -0,0 +1,88 @@
+import io
+import logging
+import os.path
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+from PIL import ImageFont
+from .templates import package_root_dir
+
+log = logging.getLogger('memebot')
+
+FONTS_DIR = os.path.join(package_root_dir, 'fonts')
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+
+DEFAULT_FONT = 'Impact'
+
+
+class FontRegistry:
+    '''Resolves font names to font files once and keeps their bytes in memory.
+
+    A name can be a path to a font file, the name of a font bundled in `fonts/`
+    (case insensitive, without extension, e.g. 'Impact' or 'xkcd-script'), or
+    anything else Pillow can find in the system font directories.
+
+    `FreeTypeFont` objects are cached per (name, size). FreeType faces can't be
+    used from several threads at once, so each render thread gets its own.
+    '''
+
+    def __init__(self, font_dirs: Iterable[str] = (FONTS_DIR,)):
+        self._bundled: Dict[str, str] = {}
+        for font_dir in font_dirs:
+            if not os.path.isdir(font_dir):
+                continue
+            for filename in os.listdir(font_dir):
+                stem, extension = os.path.splitext(filename)
+                if extension.lower() in FONT_EXTENSIONS:
+                    self._bundled.setdefault(stem.lower(), os.path.join(font_dir, filename))
+        self._data: Dict[str, bytes] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def resolve(self, name: str) -> str:
+        '''path of the font file `name` refers to'''
+        if os.path.isfile(name):
+            return name
+        bundled = self._bundled.get(name.lower())
+        if bundled:
+            return bundled
+        # let pillow search the system font directories
+        return ImageFont.truetype(name).path
+
+    def get(self, name: str, size: int) -> ImageFont.FreeTypeFont:
+        fonts: Optional[Dict[Tuple[str, int], ImageFont.FreeTypeFont]] = getattr(self._local, 'fonts', None)
+        if fonts is None:
+            fonts = self._local.fonts = {}
+        font = fonts.get((name, size))
+        if font is None:
+            font = fonts[(name, size)] = ImageFont.truetype(io.BytesIO(self._font_data(name)), size)
+        return font
+
+    def preload(self, fonts: Iterable[Tuple[str, int]]):
+        for name, size in fonts:
+            self.get(name, size)
+
+    def _font_data(self, name: str) -> bytes:
+        data = self._data.get(name)
+        if data is None:
+            path = self.resolve(name)
+            log.debug(f'loading font {name} from {path}')
+            with open(path, 'rb') as f:
+                data = f.read()
+            with self._lock:
+                self._data[name] = data
+        return data
+
+
+_font_registry: Optional[FontRegistry] = None
+
+
+def get_font_registry() -> FontRegistry:
+    global _font_registry
+    if _font_registry is None:
+        _font_registry = FontRegistry()
+    return _font_registry
+
+
+def set_font_registry(registry: Optional[FontRegistry]):
+    global _font_registry
+    _font_registry = registry
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class TextLayout:
+    '''Where and how a caption gets drawn: the wrapped text, its bounding box size,
+    the top left corner it's drawn at and the font size'''
+    __slots__ = ('text', 'width', 'height', 'position', 'fontsize')
+
+    def __init__(self, text: str, width: float, height: float, position: Tuple[float, float], fontsize: int):
+        self.text = text
+        self.width = width
+        self.height = height
+        self.position = position
+        self.fontsize = fontsize
+
+
+class LayoutCache:
+    '''Bounded LRU of `TextLayout`s. Layout only depends on the text, the drawing
+    plugin's settings and the template size, so repeated captions (and fixed `RawInput`
+    text) skip wrapping and measuring. Safe to share between render threads.'''
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._layouts: 'OrderedDict[Hashable, TextLayout]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def get(self, key: Hashable) -> Optional[TextLayout]:
+        with self._lock:
+            layout = self._layouts.get(key)
+            if layout is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._layouts.move_to_end(key)
+            return layout
+
+    def put(self, key: Hashable, layout: TextLayout):
+        with self._lock:
+            self._layouts[key] = layout
+            self._layouts.move_to_end(key)
+            while len(self._layouts) > self.max_entries:
+                self._layouts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._layouts.clear()
+
+
+_layout_cache: Optional[LayoutCache] = None
+
+
+def get_layout_cache() -> LayoutCache:
+    global _layout_cache
+    if _layout_cache is None:
+        _layout_cache = LayoutCache()
+    return _layout_cache
+
+
+def set_layout_cache(cache: Optional[LayoutCache]):
+    global _layout_cache
+    _layout_cache = cache
@@ -1,17 +1,20 @@
 import abc
+import asyncio
 import io
 import logging
 import os.path
 from pydantic import BaseModel
 from contextlib import asynccontextmanager
-from typing import List, AsyncContextManager
-from pathlib import Path
-from PIL import Image
-from .plugins import BasePlugin, USER_INPUT_KEY
-
-# this will be something like ../memebot/meme_generator
-module_path = os.path.dirname(os.path.abspath(__file__))
-package_root_dir = str(Path(module_path).parents[0])
+from typing import List, Optional, Set, Tuple
+from .plugins import BasePlugin
+from .encoding import DEFAULT_POLICY, EncodedImage, OutputPolicy, sniff_format
+from .executor import RenderExecutor, get_render_executor
+from .plan import get_plan
+from .profiling import Profile, SpanRecorder
+from .render import RenderSteps
+from .resultcache import RenderCache, render_key
+from .schedule import PrepareSchedule
+from .singleflight import SingleFlight
 
 log = logging.getLogger('memebot')
 
@@ -21,28 +24,99 @@ class Meme(BaseModel):
     aliases: List[str]
     plugins: List[BasePlugin]
     help_string: str
+    # how this template's renders get encoded, the options it sets override the policy passed to generate
+    output: Optional[OutputPolicy] = None
 
     @asynccontextmanager
-    async def generate(self, text):
-        meme_file = io.BytesIO()
+    async def generate(self, text, *, executor: Optional[RenderExecutor] = None, cache: Optional[RenderCache] = None,
+            singleflight: Optional[SingleFlight] = None, policy: Optional[OutputPolicy] = None,
+            profile: Optional[Profile] = None):
+        '''Yields the encoded meme as a file, named after the template with the extension of the output format'''
+        encoded = await self.render(text, executor=executor, cache=cache, singleflight=singleflight, policy=policy,
+            profile=profile)
+        meme_file = io.BytesIO(encoded.data)
+        meme_file.name = f'{os.path.splitext(os.path.basename(self.image_filename))[0]}.{encoded.extension}'
+        try:
+            yield meme_file
+        finally:
+            meme_file.close()
+
+    async def render(self, text: str, *, executor: Optional[RenderExecutor] = None, cache: Optional[RenderCache] = None,
+            singleflight: Optional[SingleFlight] = None, policy: Optional[OutputPolicy] = None,
+            profile: Optional[Profile] = None) -> EncodedImage:
+        '''Encoded meme for the given input. Identical renders already in flight on
+        `singleflight` are joined instead of rendered again.
+
+        With a `profile`, the spans of every stage get reported to its observers once the
+        render is done. Renders served from `cache` or joined on `singleflight` aren't reported.'''
+        policy = self.output_policy(policy)
+        if singleflight:
+            return await singleflight.do(render_key(self, text, policy),
+                lambda: self.render(text, executor=executor, cache=cache, policy=policy, profile=profile))
 
-        with Image.open(os.path.join(package_root_dir, 'assets', self.image_filename)) as image:  # type: Image.Image
-            context = {USER_INPUT_KEY: text}
+        key = cache.key(self, text, policy) if cache else None
+        data = await cache.get(key) if cache and key else None
+        if data is not None:
+            return EncodedImage(data, sniff_format(data))
 
-            for plugin in self.plugins:
-                input_text = plugin.plugin_input.get_input(context)
+        executor = executor or get_render_executor()
+        if profile is None:
+            encoded = await self._prepare_and_render(text, executor, policy)
+        else:
+            prepare_recorder = profile.recorder()
+            encoded = await self._prepare_and_render(text, executor, policy, prepare_recorder, profile.recorder())
+            profile.report(self, prepare_recorder.spans + (encoded.spans or []))
+        if cache and key:
+            await cache.put(key, encoded.data)
+        return encoded
 
-                log.debug(f'Plugin input text: {input_text}, context: {context}, plugin: {plugin!r}')
+    def output_policy(self, policy: Optional[OutputPolicy] = None) -> OutputPolicy:
+        '''`policy` (or the default one) with the options set in this meme's `output` on top'''
+        policy = policy or DEFAULT_POLICY
+        if self.output is None:
+            return policy
+        return policy.model_copy(update=self.output.model_dump(exclude_unset=True))
 
-                if input_text is not None:
-                    await plugin.run(image, input_text, context)
-                elif plugin.required:
-                    raise ValueError(f'Missing input for required plugin: {plugin}')
+    def fonts(self, scale: float = 1.0) -> Set[Tuple[str, int]]:
+        '''(font, size) pairs this meme draws text with on a template scaled by `scale`'''
+        plugins = get_plan(self, scale).steps
+        return set((step.plugin.font, step.plugin.fontsize) for step in plugins if hasattr(step.plugin, 'font'))
 
-            image.save(meme_file, format=image.format)
+    async def prepare(self, text: str, recorder: Optional[SpanRecorder] = None) -> RenderSteps:
+        '''Runs every plugin's prepare step on the event loop (context updates, downloads).
+        The returned steps are what gets sent to the render executor, in plugin order. With
+        a `recorder`, every plugin's prepare gets recorded as a span.
 
-        meme_file.seek(0)  # reset offset so that file can be read from the start
+        Plugins that don't depend on each other (see `RenderPlan`) are prepared at the same
+        time when they're I/O bound, e.g. the images of a meme download concurrently.'''
+        schedule = PrepareSchedule(get_plan(self).steps, text, recorder)
         try:
-            yield meme_file
+            await schedule.start()
+            await schedule.wait()
+            return schedule.steps()
         finally:
-            meme_file.close()
+            schedule.close()
+
+    async def _prepare_and_render(self, text: str, executor: RenderExecutor, policy: OutputPolicy,
+            prepare_recorder: Optional[SpanRecorder] = None, recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+        '''`prepare` and render. When downloads are still going once everything else is
+        prepared, a thread executor gets the render going right away (decoding the template,
+        drawing text) and the downloaded images are handed over as they come in.'''
+        schedule = PrepareSchedule(get_plan(self).steps, text, prepare_recorder)
+        try:
+            await schedule.start()
+            if not schedule.tasks or not executor.reserve_waiting_render():
+                await schedule.wait()
+                return await executor.render(self, schedule.steps(), policy, recorder)
+
+            render = asyncio.ensure_future(executor.render(self, schedule.deferred_steps(), policy, recorder))
+            try:
+                await schedule.wait()
+            except BaseException:
+                render.cancel()
+                raise
+            finally:
+                executor.release_waiting_render()
+            return await render
+        finally:
+            schedule.close()
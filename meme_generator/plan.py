@@ -0,0 +1,136 @@
+import concurrent.futures
+import logging
+import threading
+import weakref
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+from PIL import Image
+from .plugins import BasePlugin
+from .plugins.input import InputReader
+
+if TYPE_CHECKING:
+    from .meme import Meme
+    from .render import RenderSteps
+
+log = logging.getLogger('memebot')
+
+
+# context key pattern standing for every key, see `BasePlugin.output_keys`
+ANY_KEY = '*'
+
+
+class PlanStep:
+    __slots__ = ('plugin', 'read_input', 'required', 'draws', 'draw', 'reads', 'writes', 'io_bound', 'depends')
+
+    def __init__(self, plugin: BasePlugin):
+        self.plugin = plugin
+        self.read_input: Callable[[Dict], Optional[str]] = plugin.plugin_input.compile()
+        self.required = plugin.required
+        # plugins that only update the context have nothing to send to the render executor
+        self.draws = type(plugin).draw is not BasePlugin.draw
+        self.draw: Callable[[Image.Image, Any], None] = plugin.compile_draw()
+        # context keys read and written, inputs that aren't compiled to an InputReader could read anything
+        self.reads: Tuple[str, ...] = ()
+        if not isinstance(self.read_input, InputReader):
+            self.reads = (ANY_KEY,)
+        elif self.read_input.key is not None:
+            self.reads = (self.read_input.key,)
+        self.writes = plugin.output_keys()
+        self.io_bound = plugin.io_bound
+        # indexes of the earlier steps that have to be prepared before this one
+        self.depends: Tuple[int, ...] = ()
+
+
+class RenderPlan:
+    '''A `Meme` compiled for rendering: input wiring, fonts, styles and positions are
+    resolved once so that rendering doesn't go through pydantic models or build new
+    plugins. Steps line up with `Meme.plugins`.
+
+    Each step knows which earlier steps it depends on: the ones writing a context key
+    it reads, reading one it writes, or writing the same one. `Meme.prepare` runs steps
+    that don't depend on each other concurrently.
+
+    A plan is compiled for one template `scale` (see `template_scale`), with plugin
+    positions and sizes scaled to match.
+
+    Plans are cached per meme object and scale by `get_plan`, a meme that gets
+    modified after being compiled needs to be recompiled with `compile_meme`.
+    '''
+    __slots__ = ('steps', 'scale')
+
+    def __init__(self, steps: Tuple[PlanStep, ...], scale: float = 1.0):
+        self.steps = steps
+        self.scale = scale
+
+
+# (id(meme), scale) -> (weakref to meme, plan)
+_plans: Dict[Tuple[int, float], Tuple[weakref.ref, RenderPlan]] = {}
+_plans_lock = threading.Lock()
+
+
+def compile_meme(meme: 'Meme', scale: float = 1.0) -> RenderPlan:
+    plugins = meme.plugins if scale == 1.0 else [plugin.scaled(scale) for plugin in meme.plugins]
+    plan = RenderPlan(link_steps(tuple(PlanStep(plugin) for plugin in plugins)), scale)
+    meme_id = id(meme)
+
+    def forget(_):
+        with _plans_lock:
+            for key in [key for key, entry in _plans.items() if key[0] == meme_id and entry[0]() is None]:
+                del _plans[key]
+
+    with _plans_lock:
+        if scale == 1.0:
+            # recompiling at full size means the meme changed, drop its scaled plans too
+            for key in [key for key in _plans if key[0] == meme_id]:
+                del _plans[key]
+        _plans[(meme_id, scale)] = (weakref.ref(meme, forget), plan)
+    return plan
+
+
+def link_steps(steps: Tuple[PlanStep, ...]) -> Tuple[PlanStep, ...]:
+    '''Sets which earlier steps each step depends on'''
+    for index, step in enumerate(steps):
+        step.depends = tuple(earlier for earlier in range(index) if _conflict(steps[earlier], step))
+    return steps
+
+
+def _conflict(a: PlanStep, b: PlanStep) -> bool:
+    return _overlap(a.writes, b.reads) or _overlap(a.reads, b.writes) or _overlap(a.writes, b.writes)
+
+
+def _overlap(keys: Tuple[str, ...], other_keys: Tuple[str, ...]) -> bool:
+    return any(keys_overlap(key, other) for key in keys for other in other_keys)
+
+
+def keys_overlap(a: str, b: str) -> bool:
+    '''whether two context key patterns (see `BasePlugin.output_keys`) can match the same key'''
+    if a.endswith('*'):
+        return b.startswith(a[:-1]) or (b.endswith('*') and a.startswith(b[:-1]))
+    if b.endswith('*'):
+        return a.startswith(b[:-1])
+    return a == b
+
+
+def get_plan(meme: 'Meme', scale: float = 1.0) -> RenderPlan:
+    entry = _plans.get((id(meme), scale))
+    if entry is not None and entry[0]() is meme:
+        return entry[1]
+    return compile_meme(meme, scale)
+
+
+def compile_all(memes: Iterable['Meme']):
+    for meme in memes:
+        compile_meme(meme)
+
+
+# what a deferred step (see `PrepareSchedule.deferred_steps`) resolves to when it turned out to have nothing to draw
+SKIPPED = object()
+
+
+def resolve_steps(steps: 'RenderSteps') -> Iterator[Tuple[int, Any]]:
+    '''`steps` in order, waiting for the ones still being prepared on the event loop'''
+    for index, prepared in steps:
+        if isinstance(prepared, concurrent.futures.Future):
+            prepared = prepared.result()
+            if prepared is SKIPPED:
+                continue
+        yield index, prepared
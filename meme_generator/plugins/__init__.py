@@ -1,7 +1,7 @@
 from typing import Union
 from .baseplugin import BasePlugin
 from .input import UserInput, RawInput, ContextInput, USER_INPUT_KEY
-from .drawtext import DrawText, TextStyle
+from .drawtext import DrawText, TextStyle, OutlineMode
 from .drawimage import DrawImage
 from .drawinput import DrawInput
 from .spongifytext import SpongifyText
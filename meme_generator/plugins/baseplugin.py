@@ -1,14 +1,40 @@
 import abc
 from pydantic import BaseModel
-from typing import Dict, Union
+from typing import Any, Callable, ClassVar, Dict, Tuple, Union
 from PIL import Image
 from .input import AbstractInput
 
 
 class BasePlugin(BaseModel, abc.ABC):
+    '''Plugins run in two steps. `prepare` runs on the event loop and is where
+    context updates and I/O happen. Whatever it returns is handed to `draw`,
+    which runs in the render executor and does the CPU-bound image work, so it
+    must not touch the event loop (and be picklable for process pools).
+
+    Plugins that write to the context say which keys in `output_keys`, the order
+    plugins get prepared in is worked out from that (see `RenderPlan`).'''
+    # prepare waits on I/O (downloads), so it runs alongside the plugins that don't depend on it
+    io_bound: ClassVar[bool] = False
+
     plugin_input: AbstractInput
     required: bool = True
 
-    @abc.abstractmethod
-    async def run(self, image: Image, text: str, context: Dict):
+    def output_keys(self) -> Tuple[str, ...]:
+        '''Context keys `prepare` writes, a trailing * matches every key starting with what's before it'''
+        return ()
+
+    async def prepare(self, text: str, context: Dict) -> Any:
+        return text
+
+    def draw(self, image: Image.Image, prepared: Any):
         pass
+
+    def compile_draw(self) -> Callable[[Image.Image, Any], None]:
+        '''`draw` with everything that doesn't depend on the input resolved ahead of time,
+        used by render plans'''
+        return self.draw
+
+    def scaled(self, scale: float) -> 'BasePlugin':
+        '''Copy of this plugin for drawing on the template resized by `scale`.
+        Plugins with pixel positions or sizes override this.'''
+        return self
@@ -2,44 +2,132 @@ import textwrap
 import io
 import os
 import math
-import aiohttp
-from contextlib import asynccontextmanager
+import time
 from pydantic import Field
-from typing import Dict, Optional
+from typing import ClassVar, Dict, Optional, Tuple, Union
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
+from ..remotecache import RemoteImage, get_decoded_image_cache, get_remote_image_cache
 from .baseplugin import BasePlugin
 from .utils import Coordinate, find_centered_position
 
+# refuse to decode user images bigger than this, about a 8000x6000 photo
+MAX_IMAGE_PIXELS = 50_000_000
+# seconds a user image may take to decode before it's dropped
+DECODE_TIME_BUDGET = 2.0
+# images get reduced by an integer factor until they're less than this many times the
+# final size, then resampled
+REDUCING_GAP = 3
+
+
+class ImageDecodeError(ValueError):
+    pass
+
+
 class DrawImage(BasePlugin):
+    io_bound: ClassVar[bool] = True
+
     position: Coordinate
     max_size: Optional[Coordinate] = None
 
-    async def run(self, image: Image, url: str, context: Dict):
-        async with self.open_image(url) as custom_image:
-            max_size_x = self.max_size.x if self.max_size else image.size[0] // 2
-            max_size_y = self.max_size.y if self.max_size else image.size[1] // 2
+    async def prepare(self, url: str, context: Dict) -> RemoteImage:
+        return await fetch_image(url)
+
+    def scaled(self, scale: float) -> 'DrawImage':
+        return self.model_copy(update=dict(
+            position=self.position.scaled(scale),
+            max_size=self.max_size.scaled(scale) if self.max_size else None))
+
+    def draw(self, image: Image.Image, remote_image: Union[RemoteImage, bytes]):
+        max_size_x = self.max_size.x if self.max_size else image.size[0] // 2
+        max_size_y = self.max_size.y if self.max_size else image.size[1] // 2
+
+        custom_image = load_image(remote_image, (max_size_x, max_size_y))
+        pos_x, pos_y = find_centered_position((self.position.x, self.position.y), custom_image.size)
+
+        image.paste(custom_image, box=(pos_x, pos_y))
+
+
+def load_image(remote_image: Union[RemoteImage, bytes], max_size: Tuple[int, int]) -> Image.Image:
+    '''`decode_image`, reusing the decoded copy of images seen before at this size'''
+    if isinstance(remote_image, bytes):
+        return decode_image(remote_image, max_size)
+    if remote_image.digest is None:
+        return decode_image(remote_image.data, max_size)
+
+    decoded_cache = get_decoded_image_cache()
+    key = (remote_image.digest, max_size)
+    custom_image = decoded_cache.get(key)
+    if custom_image is None:
+        custom_image = decode_image(remote_image.data, max_size)
+        decoded_cache.put(key, custom_image)
+    return custom_image
+
+
+def decode_image(data: bytes, max_size: Tuple[int, int], max_pixels: int = MAX_IMAGE_PIXELS,
+        time_budget: float = DECODE_TIME_BUDGET) -> Image.Image:
+    '''Decodes `data` scaled to fit in `max_size`.
+
+    The size is checked from the header before anything gets decoded. JPEGs are
+    decoded at the smallest DCT scale that is still at least `max_size` (draft mode),
+    which skips most of the work for big photos, and other formats are shrunk with
+    `reduce` before the final resample. Raises ImageDecodeError if the image has more
+    than `max_pixels` pixels or takes longer than `time_budget` seconds: the deadline is
+    checked every time the decoder reads another block and between the resize steps, so
+    the work stops there. Formats decoded in a single call (WebP) only get checked
+    before and after it.'''
+    deadline = DeadlineReader(data, time.perf_counter() + time_budget)
+    with Image.open(deadline) as custom_image:
+        width, height = custom_image.size
+        if width * height > max_pixels:
+            raise ImageDecodeError(f'Image is too large: {width}x{height}')
+
+        resize_ratio = min(max_size[0] / width, max_size[1] / height)
+        size = (max(1, math.floor(width * resize_ratio)), max(1, math.floor(height * resize_ratio)))
+
+        if resize_ratio < 1:
+            custom_image.draft(custom_image.mode, size)
+        custom_image.load()
+        deadline.check()
+
+        if size == custom_image.size:
+            return custom_image.copy()
+        # what resize does with reducing_gap=3.0, in two steps to check the deadline between
+        factor = min(custom_image.size[0] // size[0], custom_image.size[1] // size[1]) // REDUCING_GAP
+        reduced = reducible(custom_image).reduce(factor) if factor > 1 else custom_image
+        deadline.check()
+        return reduced.resize(size, resample=Image.LANCZOS)
+
+
+def reducible(image: Image.Image) -> Image.Image:
+    '''`image`, converted if it's in a mode `reduce` doesn't work on (palette GIFs and PNGs,
+    bilevel and 16 bit images)'''
+    if image.mode == 'P':
+        return image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    if image.mode == '1':
+        return image.convert('L')
+    if image.mode == 'I;16':
+        return image.convert('I')
+    return image
+
 
-            resize_ratio = min(max_size_x / custom_image.size[0], max_size_y / custom_image.size[1])
+class DeadlineReader(io.BytesIO):
+    '''Image data that raises ImageDecodeError once `deadline` (a `time.perf_counter`
+    time) has passed, when the decoder reads its next block'''
 
-            size_x = math.floor(custom_image.size[0] * resize_ratio)
-            size_y = math.floor(custom_image.size[1] * resize_ratio)
+    def __init__(self, data: bytes, deadline: float):
+        super().__init__(data)
+        self.deadline = deadline
 
-            if (size_x, size_y) != custom_image.size:
-                custom_image = custom_image.resize((size_x, size_y), resample=Image.LANCZOS)
+    def check(self):
+        if time.perf_counter() > self.deadline:
+            raise ImageDecodeError('Image took too long to decode')
 
-            size_x, size_y = custom_image.size[0], custom_image.size[1]
-            pos_x, pos_y = find_centered_position((self.position.x, self.position.y), (size_x, size_y))
+    def read(self, size: Optional[int] = -1) -> bytes:
+        self.check()
+        return super().read(size)
 
-            image.paste(custom_image, box=(pos_x, pos_y))
 
-    @asynccontextmanager
-    async def open_image(self, url): 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                image = Image.open(io.BytesIO(await response.read()))
-            try:
-                yield image
-            finally:
-                image.close()
+async def fetch_image(url: str) -> RemoteImage:
+    return await get_remote_image_cache().get(url)
@@ -1,27 +1,63 @@
 import textwrap
 import enum
-from typing import Dict, Tuple, Optional
+from typing import Any, Callable, ClassVar, Dict, Tuple, Optional
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
+from ..fonts import DEFAULT_FONT
 from .baseplugin import BasePlugin
-from .drawtext import DrawText, TextStyle
-from .drawimage import DrawImage
-from .utils import Coordinate, Position, AutoPosition
+from .drawtext import DrawText, TextDrawer, TextStyle, OutlineMode
+from ..remotecache import RemoteImage
+from .drawimage import DrawImage, fetch_image
+from .utils import Coordinate, Position, AutoPosition, scale_size
 
 
 class DrawInput(BasePlugin):
+    io_bound: ClassVar[bool] = True
+
     position: Coordinate
     maxwidth: int = 20
     fontsize: int = 48
     textstyle: TextStyle = TextStyle.WHITE
+    font: str = DEFAULT_FONT
+    outline: OutlineMode = OutlineMode.STROKE
     max_size: Optional[Coordinate] = None
+    # shrink text to fit in max_size, see DrawText.fit_box
+    autofit: bool = False
 
-    async def run(self, image: Image, text: str, context: Dict):
+    async def prepare(self, text: str, context: Dict) -> Any:
         if text.startswith('http://') or text.startswith('https://'):
-            draw_image = DrawImage(plugin_input=self.plugin_input, position=self.position, max_size=self.max_size)
-            return await draw_image.run(image, text, context)
+            return await fetch_image(text)
+        else:
+            return text
+
+    def draw(self, image: Image.Image, prepared: Any):
+        self.compile_draw()(image, prepared)
+
+    def scaled(self, scale: float) -> 'DrawInput':
+        return self.model_copy(update=dict(
+            position=self.position.scaled(scale),
+            fontsize=scale_size(self.fontsize, scale),
+            max_size=self.max_size.scaled(scale) if self.max_size else None))
+
+    def compile_draw(self) -> 'InputDrawer':
+        draw_text = DrawText(plugin_input=self.plugin_input, position=self.position,
+            maxwidth=self.maxwidth, fontsize=self.fontsize, textstyle=self.textstyle, font=self.font, outline=self.outline,
+            fit_box=self.max_size if self.autofit else None)
+        draw_image = DrawImage(plugin_input=self.plugin_input, position=self.position, max_size=self.max_size)
+        return InputDrawer(draw_text.compile_draw(), draw_image.compile_draw())
+
+
+class InputDrawer:
+    __slots__ = ('draw_text', 'draw_image')
+
+    def __init__(self, draw_text: TextDrawer, draw_image: Callable[[Image.Image, RemoteImage], None]):
+        self.draw_text = draw_text
+        self.draw_image = draw_image
+
+    def __call__(self, image: Image.Image, prepared: Any):
+        # prepare hands over downloaded images as RemoteImage and the text otherwise
+        if isinstance(prepared, RemoteImage):
+            self.draw_image(image, prepared)
         else:
-            draw_text = DrawText(plugin_input=self.plugin_input, position=self.position,
-                maxwidth=self.maxwidth, fontsize=self.fontsize, textstyle=self.textstyle)
-            return await draw_text.run(image, text, context)
+            self.draw_text(image, prepared)
@@ -1,11 +1,13 @@
 import textwrap
 import enum
-from typing import Dict, Tuple
+from typing import Dict, Optional, Tuple, Union
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw
+from ..fonts import DEFAULT_FONT, get_font_registry
+from ..layout import TextLayout, get_layout_cache
 from .baseplugin import BasePlugin
-from .utils import Coordinate, Position, AutoPosition, find_centered_position
+from .utils import Coordinate, Position, AutoPosition, find_centered_position, scale_position, scale_size
 
 
 class TextStyle(enum.Enum):
@@ -13,34 +15,166 @@ class TextStyle(enum.Enum):
     BLACK = 2
 
 
+class OutlineMode(enum.Enum):
+    '''how the black outline around white text is drawn'''
+    STROKE = 1  # single pass using freetype's stroker, width scales with the font size
+    OFFSET = 2  # text drawn 4 times offset by a pixel, then once more on top. slower, original look
+
+
+# outline width relative to font size in STROKE mode
+STROKE_WIDTH_RATIO = 1 / 24
+
+# most font sizes measured when fitting text into `DrawText.fit_box`, the fallback
+# to min_fontsize included: the first try at fontsize, a binary search over up to 511
+# smaller sizes (9) and the fallback. Wider ranges settle for the best size found.
+MAX_FIT_ITERATIONS = 11
+
+
 class DrawText(BasePlugin):
     position: Position = AutoPosition.BOTTOM
     maxwidth: int = 20
     fontsize: int = 48
     textstyle: TextStyle = TextStyle.WHITE
+    font: str = DEFAULT_FONT
+    outline: OutlineMode = OutlineMode.STROKE
+    # when set, text is wrapped by pixel width and drawn at the largest size
+    # between min_fontsize and fontsize that fits in this box around position
+    fit_box: Optional[Coordinate] = None
+    min_fontsize: int = 12
+
+    def draw(self, image: Image.Image, text: str):
+        self.compile_draw()(image, text)
+
+    def scaled(self, scale: float) -> 'DrawText':
+        # min_fontsize is a legibility floor, so it stays as is
+        return self.model_copy(update=dict(
+            position=scale_position(self.position, scale),
+            fontsize=scale_size(self.fontsize, scale),
+            fit_box=self.fit_box.scaled(scale) if self.fit_box else None))
+
+    def compile_draw(self) -> 'TextDrawer':
+        return TextDrawer(self)
 
-    async def run(self, image: Image.Image, text: str, context: Dict):
+
+class TextDrawer:
+    '''`DrawText.draw` with the plugin's settings resolved once'''
+    __slots__ = ('font', 'fontsize', 'min_fontsize', 'maxwidth', 'position', 'fit_box',
+        'textstyle', 'outline', 'layout_key')
+
+    def __init__(self, plugin: DrawText):
+        self.font = plugin.font
+        self.fontsize = plugin.fontsize
+        self.min_fontsize = min(plugin.min_fontsize, plugin.fontsize)
+        self.maxwidth = plugin.maxwidth
+        self.position: Union[AutoPosition, Tuple[int, int]] = (
+            (plugin.position.x, plugin.position.y) if isinstance(plugin.position, Coordinate) else plugin.position)
+        self.fit_box = (plugin.fit_box.x, plugin.fit_box.y) if plugin.fit_box else None
+        self.textstyle = plugin.textstyle
+        self.outline = plugin.outline
+        # the style matters too, white text leaves room for its outline when fitting
+        self.layout_key = (self.font, self.fontsize, self.min_fontsize, self.maxwidth, self.position, self.fit_box,
+            self.textstyle, self.outline)
+
+    def __call__(self, image: Image.Image, text: str):
         draw = ImageDraw.Draw(image)
-        font = ImageFont.truetype('Impact', self.fontsize)
-        text = textwrap.fill(text, self.maxwidth)
 
-        textbox = draw.multiline_textbbox((0,0), text, font=font)
-        width = textbox[2]
-        height = textbox[3]
+        layout_cache = get_layout_cache()
+        layout_key = (self.layout_key, image.size, text)
+        layout = layout_cache.get(layout_key)
+        if layout is None:
+            layout = self.layout(draw, image.size, text)
+            layout_cache.put(layout_key, layout)
+        drawposition, text = layout.position, layout.text
+        font = get_font_registry().get(self.font, layout.fontsize)
+
+        if self.textstyle == TextStyle.WHITE and self.outline == OutlineMode.STROKE:
+            draw_stroked_text(draw, drawposition, text, font=font, stroke_width=stroke_width(layout.fontsize))
+        elif self.textstyle == TextStyle.WHITE:
+            draw_outlined_text(draw, drawposition, text, font=font)
+        else:
+            draw.multiline_text(drawposition, text, fill='black', align='center', spacing=4, font=font)
+
+    def layout(self, draw: ImageDraw.ImageDraw, image_size: Tuple[int, int], text: str) -> TextLayout:
+        if self.fit_box:
+            fontsize, text, width, height = self.fit(draw, text, self.fit_box)
+        else:
+            fontsize = self.fontsize
+            text = textwrap.fill(text, self.maxwidth)
+            textbox = draw.multiline_textbbox((0,0), text, font=get_font_registry().get(self.font, fontsize))
+            width = textbox[2]
+            height = textbox[3]
 
         if self.position == AutoPosition.TOP:
-            drawposition = ((image.size[0] / 2) - (width / 2), image.size[1] * 0.05)
+            drawposition = ((image_size[0] / 2) - (width / 2), image_size[1] * 0.05)
         elif self.position == AutoPosition.CENTER:
-            drawposition = ((image.size[0] / 2) - (width / 2), (image.size[1] * 0.5) - (height / 2))
+            drawposition = ((image_size[0] / 2) - (width / 2), (image_size[1] * 0.5) - (height / 2))
         elif self.position == AutoPosition.BOTTOM:
-            drawposition = ((image.size[0] / 2) - (width / 2), (image.size[1] * 0.95) - height)
-        elif isinstance(self.position, Coordinate):
-            drawposition = (self.position.x - (width / 2), self.position.y - (height / 2))
-
-        if self.textstyle == TextStyle.WHITE:
-            draw_outlined_text(draw, drawposition, text, font=font)
+            drawposition = ((image_size[0] / 2) - (width / 2), (image_size[1] * 0.95) - height)
         else:
-            draw.multiline_text(drawposition, text, fill='black', align='center', spacing=4, font=font)
+            drawposition = (self.position[0] - (width / 2), self.position[1] - (height / 2))
+
+        return TextLayout(text, width, height, drawposition, fontsize)
+
+    def fit(self, draw: ImageDraw.ImageDraw, text: str, box: Tuple[int, int]) -> Tuple[int, str, float, float]:
+        '''Binary search for the largest font size whose pixel wrapped text fits in `box`,
+        measuring at most MAX_FIT_ITERATIONS sizes. Falls back to the smallest size
+        (which might still overflow) if nothing fits.'''
+        best = None
+        fallback = None
+        low, high = self.min_fontsize, self.fontsize
+        size = high  # short captions usually fit at full size, so try that first
+
+        # the last measurement is kept for the fallback
+        for _ in range(MAX_FIT_ITERATIONS - 1):
+            if low > high:
+                break
+            wrapped, width, height, outline = self.measure(draw, text, box, size)
+            if width + outline <= box[0] and height + outline <= box[1]:
+                best = (size, wrapped, width, height)
+                low = size + 1
+            else:
+                if size == self.min_fontsize:
+                    fallback = (size, wrapped, width, height)
+                high = size - 1
+            size = (low + high) // 2
+
+        if best is None and fallback is None:
+            fallback = (self.min_fontsize,) + self.measure(draw, text, box, self.min_fontsize)[:3]
+        return best or fallback
+
+    def measure(self, draw: ImageDraw.ImageDraw, text: str, box: Tuple[int, int],
+            size: int) -> Tuple[str, float, float, int]:
+        '''`text` wrapped to the width of `box` at `size`, its width and height, and how much
+        the outline adds to both'''
+        font = get_font_registry().get(self.font, size)
+        outline = 2 * stroke_width(size) if self.textstyle == TextStyle.WHITE else 0
+        wrapped = wrap_to_width(text, font, box[0] - outline)
+        textbox = draw.multiline_textbbox((0,0), wrapped, font=font)
+        return wrapped, textbox[2], textbox[3], outline
+
+
+def wrap_to_width(text: str, font: ImageFont.FreeTypeFont, max_width: float) -> str:
+    '''greedy word wrap by rendered width instead of character count'''
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            candidate = f'{line} {word}' if line else word
+            if line and font.getlength(candidate) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def stroke_width(fontsize: int) -> int:
+    return max(1, round(fontsize * STROKE_WIDTH_RATIO))
+
+
+def draw_stroked_text(draw: ImageDraw.ImageDraw, position, text: str, **kwargs):
+    draw.multiline_text(position, text, fill='white', stroke_fill='black', align='center', spacing=4, **kwargs)
 
 
 def draw_outlined_text(draw: ImageDraw.ImageDraw, position, text: str, **kwargs):
@@ -51,4 +185,3 @@ def draw_outlined_text(draw: ImageDraw.ImageDraw, position, text: str, **kwargs)
     draw.multiline_text((x-1, y+1), text, fill='black', align='center', spacing=4, **nonfill_kargs)
     draw.multiline_text((x+1, y+1), text, fill='black', align='center', spacing=4, **nonfill_kargs)
     draw.multiline_text(position, text, fill='white', align='center', spacing=4, **kwargs)
-
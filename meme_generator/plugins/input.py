@@ -1,15 +1,40 @@
 import abc
-from typing import Dict, Optional
+from typing import Callable, Dict, Optional
 from pydantic import BaseModel
 
 USER_INPUT_KEY = 'user_input'
 
 
+class InputReader:
+    '''Precompiled `AbstractInput.get_input`, reads `key` from the context
+    (or returns the constant `text` when there is no key)'''
+    __slots__ = ('key', 'text', 'prefix', 'suffix', 'skip_empty')
+
+    def __init__(self, key: Optional[str] = None, text: Optional[str] = None,
+            prefix: str = '', suffix: str = '', skip_empty: bool = False):
+        self.key = key
+        self.text = text
+        self.prefix = prefix
+        self.suffix = suffix
+        self.skip_empty = skip_empty
+
+    def __call__(self, context: Dict) -> Optional[str]:
+        if self.key is None:
+            return self.text
+        text = context.get(self.key)
+        if text is None or (self.skip_empty and not text):
+            return None
+        return self.prefix + text + self.suffix
+
+
 class AbstractInput(BaseModel, abc.ABC):
     @abc.abstractmethod
     def get_input(self, context: Dict) -> Optional[str]:
         pass
 
+    def compile(self) -> Callable[[Dict], Optional[str]]:
+        return self.get_input
+
 
 class RawInput(AbstractInput):
     text: str
@@ -17,11 +42,17 @@ class RawInput(AbstractInput):
     def get_input(self, context: Dict) -> str:
         return self.text
 
+    def compile(self) -> InputReader:
+        return InputReader(text=self.text)
+
 
 class UserInput(AbstractInput):
     def get_input(self, context: Dict) -> Optional[str]:
         return context.get(USER_INPUT_KEY)
 
+    def compile(self) -> InputReader:
+        return InputReader(key=USER_INPUT_KEY)
+
 
 class ContextInput(AbstractInput):
     key: str
@@ -35,3 +66,6 @@ class ContextInput(AbstractInput):
         prefix = self.prefix or ''
         suffix = self.suffix or ''
         return prefix + text + suffix
+
+    def compile(self) -> InputReader:
+        return InputReader(key=self.key, prefix=self.prefix or '', suffix=self.suffix or '', skip_empty=True)
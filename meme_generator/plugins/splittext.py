@@ -1,5 +1,5 @@
 import re
-from typing import Dict
+from typing import Dict, Tuple
 from PIL import Image
 from .baseplugin import BasePlugin
 
@@ -10,7 +10,10 @@ class SplitText(BasePlugin):
     class Config:
         arbitrary_types_allowed = True
 
-    async def run(self, image: Image, text: str, context: Dict):
+    def output_keys(self) -> Tuple[str, ...]:
+        return ('text-*',)
+
+    async def prepare(self, text: str, context: Dict):
         non_empty_args = filter(None, self.regex.split(text))
         for (i, item) in enumerate(non_empty_args, 1):
             context[f'text-{i}'] = item.strip()
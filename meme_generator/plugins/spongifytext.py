@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 from PIL import Image
 from .baseplugin import BasePlugin
 
@@ -6,6 +6,9 @@ from .baseplugin import BasePlugin
 class SpongifyText(BasePlugin):
     output_key: str = 'spongified-text'
 
-    async def run(self, image: Image, text: str, context: Dict):
+    def output_keys(self) -> Tuple[str, ...]:
+        return (self.output_key,)
+
+    async def prepare(self, text: str, context: Dict):
         vowels = set('aoeuiAOEUI')
         context[self.output_key] = ''.join(letter.lower() if letter in vowels else letter.upper() for letter in text)
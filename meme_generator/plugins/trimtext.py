@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Tuple
 from PIL import Image
 from .baseplugin import BasePlugin
 
@@ -7,5 +7,8 @@ class TrimText(BasePlugin):
     numwords: int
     output_key: str = 'trimmed-text'
 
-    async def run(self, image: Image, text: str, context: Dict):
+    def output_keys(self) -> Tuple[str, ...]:
+        return (self.output_key,)
+
+    async def prepare(self, text: str, context: Dict):
         context[self.output_key] = ''.join(text.split(' ')[:self.numwords])
@@ -14,6 +14,9 @@ class Coordinate(BaseModel):
     x: int
     y: int
 
+    def scaled(self, scale: float) -> 'Coordinate':
+        return Coordinate(x=round(self.x * scale), y=round(self.y * scale))
+
 
 class AutoPosition(AutoName):
     TOP = auto()
@@ -24,6 +27,14 @@ class AutoPosition(AutoName):
 Position = Union[AutoPosition, Coordinate]
 
 
+def scale_position(position: Position, scale: float) -> Position:
+    return position.scaled(scale) if isinstance(position, Coordinate) else position
+
+
+def scale_size(size: int, scale: float) -> int:
+    return max(1, round(size * scale))
+
+
 def find_centered_position(center, size):
     offset_x = _find_offset(size[0], center[0])
     offset_y = _find_offset(size[1], center[1])
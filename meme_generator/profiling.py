@@ -0,0 +1,145 @@
+import logging
+import time
+import tracemalloc
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .meme import Meme
+
+log = logging.getLogger('memebot')
+
+STAGES = ('prepare', 'template', 'draw', 'encode')
+
+
+class Span:
+    '''How long one stage of a render took. `stage` is one of `STAGES`; prepare and draw
+    spans also have the plugin's index in `Meme.plugins` and its class name. A plugin's
+    prepare span covers its downloads, e.g. `DrawImage` fetching the user's image.
+
+    `allocated_bytes` is only measured when profiling memory: the peak growth of memory
+    traced by tracemalloc during the stage. That's Python allocations (text layouts,
+    downloaded and encoded bytes), pixel buffers Pillow allocates itself aren't traced.
+    tracemalloc is process wide, so renders running at the same time in other threads
+    show up in each other's numbers.
+    '''
+    __slots__ = ('stage', 'seconds', 'allocated_bytes', 'index', 'plugin')
+
+    def __init__(self, stage: str, seconds: float, allocated_bytes: Optional[int] = None,
+            index: Optional[int] = None, plugin: Optional[str] = None):
+        self.stage = stage
+        self.seconds = seconds
+        self.allocated_bytes = allocated_bytes
+        self.index = index
+        self.plugin = plugin
+
+    @property
+    def name(self) -> str:
+        return self.stage if self.plugin is None else f'{self.stage} {self.index}:{self.plugin}'
+
+    def __repr__(self):
+        return f'Span({self.name!r}, seconds={self.seconds:.4f}, allocated_bytes={self.allocated_bytes})'
+
+
+class SpanRecorder:
+    '''Collects the spans of one render. Gets sent to process pool workers along with the
+    render, so it only holds picklable state.'''
+    __slots__ = ('memory', 'spans')
+
+    def __init__(self, memory: bool = False):
+        self.memory = memory
+        self.spans: List[Span] = []
+
+    def start(self) -> Tuple[float, int]:
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            traced, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            return time.perf_counter(), traced
+        return time.perf_counter(), 0
+
+    def record(self, stage: str, start: Tuple[float, int], index: Optional[int] = None, plugin: Any = None):
+        seconds = time.perf_counter() - start[0]
+        allocated = tracemalloc.get_traced_memory()[1] - start[1] if self.memory else None
+        self.spans.append(Span(stage, seconds, allocated, index, None if plugin is None else type(plugin).__name__))
+
+
+# called after every profiled render with the meme and its spans in the order they ran
+RenderObserver = Callable[['Meme', List[Span]], None]
+
+
+class Profile:
+    '''Pass to `Meme.generate`/`Meme.render` to have each render's stages timed and
+    reported to `observers`. Renders without a profile don't measure anything.
+
+    With `memory`, allocations are traced too (see `Span`). That starts tracemalloc,
+    which stays on and slows down every allocation in the process, so it's for
+    tracking a problem down rather than leaving on.
+    '''
+    __slots__ = ('observers', 'memory')
+
+    def __init__(self, *observers: RenderObserver, memory: bool = False):
+        self.observers = list(observers)
+        self.memory = memory
+
+    def __repr__(self):
+        return f'Profile(observers={self.observers!r}, memory={self.memory})'
+
+    def recorder(self) -> SpanRecorder:
+        return SpanRecorder(self.memory)
+
+    def report(self, meme: 'Meme', spans: List[Span]):
+        for observer in self.observers:
+            try:
+                observer(meme, spans)
+            except Exception:
+                log.exception(f'render observer {observer!r} failed')
+
+
+def format_spans(spans: List[Span]) -> str:
+    return ', '.join(f'{span.name} {span.seconds * 1000:.1f}ms'
+        + (f' {span.allocated_bytes} bytes' if span.allocated_bytes is not None else '') for span in spans)
+
+
+class SlowRenderLogger:
+    '''Logs the breakdown of renders whose stages took `min_seconds` or more in total'''
+
+    def __init__(self, min_seconds: float = 1.0, level: int = logging.INFO):
+        self.min_seconds = min_seconds
+        self.level = level
+
+    def __repr__(self):
+        return f'SlowRenderLogger(min_seconds={self.min_seconds})'
+
+    def __call__(self, meme: 'Meme', spans: List[Span]):
+        total = sum(span.seconds for span in spans)
+        if total >= self.min_seconds:
+            log.log(self.level, f'rendering {meme.aliases[0]} took {total * 1000:.1f}ms: {format_spans(spans)}')
+
+
+class StageStats:
+    '''Running totals per (meme, span name), e.g. for a stats command or to export as metrics'''
+
+    def __init__(self):
+        # (alias, span name) -> [count, total seconds, max seconds, total allocated bytes]
+        self.stages: Dict[Tuple[str, str], List[float]] = {}
+
+    def __repr__(self):
+        return f'StageStats(stages={len(self.stages)})'
+
+    def __call__(self, meme: 'Meme', spans: List[Span]):
+        alias = meme.aliases[0]
+        for span in spans:
+            stats = self.stages.get((alias, span.name))
+            if stats is None:
+                stats = self.stages[(alias, span.name)] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += span.seconds
+            stats[2] = max(stats[2], span.seconds)
+            stats[3] += span.allocated_bytes or 0
+
+    def slowest(self, count: int = 5) -> List[Tuple[str, str, Dict[str, float]]]:
+        '''(alias, span name, stats) of the stages with the most total time'''
+        ranked = sorted(self.stages.items(), key=lambda item: item[1][1], reverse=True)[:count]
+        return [(alias, name, dict(count=stats[0], total_seconds=stats[1], max_seconds=stats[2],
+            allocated_bytes=stats[3])) for (alias, name), stats in ranked]
@@ -0,0 +1,206 @@
+import threading
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+from pygtrie import CharTrie
+from .meme import Meme
+from .definitions import MemeChanges
+
+
+# how similar (dice coefficient of trigrams) an alias has to be to a mistyped one to be suggested
+SUGGESTION_MIN_SCORE = 0.4
+MAX_SUGGESTIONS = 3
+
+
+class MemeRegistryError(ValueError):
+    pass
+
+
+def normalize_alias(text: str) -> str:
+    '''case folded, with runs of whitespace collapsed to a single space'''
+    return ' '.join(text.casefold().split())
+
+
+def _normalize_head(text: str, limit: int) -> Tuple[str, List[int]]:
+    '''`normalize_alias` of the start of `text`, up to `limit` characters, along with
+    the index in `text` right after each normalized character'''
+    normalized: List[str] = []
+    ends: List[int] = []
+    for index, char in enumerate(text):
+        if len(normalized) >= limit:
+            break
+        if char.isspace():
+            if normalized and normalized[-1] != ' ':
+                normalized.append(' ')
+                ends.append(index + 1)
+            continue
+        for folded in char.casefold():
+            normalized.append(folded)
+            ends.append(index + 1)
+    return ''.join(normalized), ends
+
+
+def trigrams(text: str) -> FrozenSet[str]:
+    '''trigrams of a normalized alias, padded so the start and end of words count more'''
+    padded = f'  {text} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class MemeMatch:
+    '''A meme found at the start of a command. `alias` is the matched alias in its
+    normalized form, `end` is where it ends in the command and `text` is what's left.'''
+    __slots__ = ('meme', 'alias', 'end', 'text')
+
+    def __init__(self, meme: Meme, alias: str, end: int, text: str):
+        self.meme = meme
+        self.alias = alias
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return f'MemeMatch(meme={self.meme.aliases[0]!r}, alias={self.alias!r}, end={self.end}, text={self.text!r})'
+
+
+class MemeRegistry:
+    '''Every meme by alias, the one place commands get resolved to memes.
+
+    Aliases are indexed normalized (`normalize_alias`), so `resolve` matches commands
+    regardless of case and spacing. When nothing matches, `suggest` finds the closest
+    aliases through a trigram index. Memes can be added and removed as they're reloaded,
+    which only touches their own aliases.
+    '''
+
+    def __init__(self, memes: Iterable[Meme] = ()):
+        self._aliases = CharTrie()
+        self._memes: Dict[int, Meme] = {}
+        self._max_alias_length = 0
+        self._max_alias_words = 0
+        # trigram -> normalized aliases containing it
+        self._trigram_index: Dict[str, Set[str]] = {}
+        self._alias_trigrams: Dict[str, FrozenSet[str]] = {}
+        self._lock = threading.Lock()
+        for meme in memes:
+            self.add(meme)
+
+    def __repr__(self):
+        return f'MemeRegistry(memes={len(self._memes)}, aliases={len(self._aliases)})'
+
+    def __len__(self):
+        return len(self._memes)
+
+    def __iter__(self) -> Iterator[Meme]:
+        return iter(list(self._memes.values()))
+
+    def __contains__(self, meme: Meme):
+        return self._memes.get(id(meme)) is meme
+
+    @property
+    def memes(self) -> List[Meme]:
+        return list(self._memes.values())
+
+    def add(self, meme: Meme):
+        aliases = [normalize_alias(alias) for alias in meme.aliases]
+        with self._lock:
+            for alias in aliases:
+                existing = self._aliases.get(alias)
+                if existing is not None and existing is not meme:
+                    raise MemeRegistryError(f'alias {alias!r} of {meme.aliases[0]} is already used by {existing.aliases[0]}')
+            for alias in aliases:
+                self._aliases[alias] = meme
+                self._alias_trigrams[alias] = trigrams(alias)
+                for trigram in self._alias_trigrams[alias]:
+                    self._trigram_index.setdefault(trigram, set()).add(alias)
+            self._memes[id(meme)] = meme
+            self._max_alias_length = max([self._max_alias_length] + [len(alias) for alias in aliases])
+            self._max_alias_words = max([self._max_alias_words] + [alias.count(' ') + 1 for alias in aliases])
+
+    def remove(self, meme: Meme):
+        with self._lock:
+            if self._memes.pop(id(meme), None) is None:
+                return
+            for alias in meme.aliases:
+                alias = normalize_alias(alias)
+                if self._aliases.get(alias) is meme:
+                    del self._aliases[alias]
+                    for trigram in self._alias_trigrams.pop(alias):
+                        self._trigram_index[trigram].discard(alias)
+
+    def update(self, changes: MemeChanges) -> List[Meme]:
+        '''Applies a `MemeLibrary.reload`, returns the added memes that clashed with
+        aliases already in use and were left out'''
+        for meme in changes.removed:
+            self.remove(meme)
+        rejected = []
+        for meme in changes.added:
+            try:
+                self.add(meme)
+            except MemeRegistryError:
+                rejected.append(meme)
+        return rejected
+
+    def get(self, alias: str) -> Optional[Meme]:
+        return self._aliases.get(normalize_alias(alias))
+
+    def resolve(self, command: str) -> Optional[MemeMatch]:
+        '''The meme with the longest alias `command` starts with'''
+        # an alias can't match more than this much of the command, so only that gets normalized
+        limit = self._max_alias_length + 1
+        start = len(command) - len(command.lstrip())
+        head = command[start:start + limit]
+        normalized = normalize_alias(head)
+        if head.startswith(normalized):
+            # already lower case and single spaced, as commands usually are
+            step = self._aliases.longest_prefix(normalized)
+            if not step:
+                return None
+            end = start + len(step.key)
+        else:
+            normalized, ends = _normalize_head(command, limit)
+            step = self._aliases.longest_prefix(normalized)
+            if not step:
+                return None
+            end = ends[len(step.key) - 1]
+        return MemeMatch(step.value, step.key, end, command[end:].strip())
+
+    def suggest(self, command: str, limit: int = MAX_SUGGESTIONS,
+            min_score: float = SUGGESTION_MIN_SCORE) -> List[Meme]:
+        '''Memes whose aliases look most like the start of `command`, best first, for
+        when `resolve` found nothing. Each alias is compared with as many words of the
+        command as it has itself.'''
+        words = normalize_alias(command[:self._max_alias_length * 2]).split(' ')[:self._max_alias_words]
+        if not words[0]:
+            return []
+        # number of words -> trigrams of the command's first that many words
+        heads = {len(words): trigrams(' '.join(words))}
+        candidates: Set[str] = set()
+        for trigram in heads[len(words)]:
+            candidates.update(self._trigram_index.get(trigram, ()))
+
+        scores: Dict[int, Tuple[float, Meme]] = {}
+        for alias in candidates:
+            alias_trigrams = self._alias_trigrams[alias]
+            count = min(alias.count(' ') + 1, len(words))
+            head = heads.get(count)
+            if head is None:
+                head = heads[count] = trigrams(' '.join(words[:count]))
+            score = 2 * len(alias_trigrams & head) / (len(alias_trigrams) + len(head))
+            meme = self._aliases[alias]
+            if score >= min_score and score > scores.get(id(meme), (0.0, None))[0]:
+                scores[id(meme)] = (score, meme)
+        ranked = sorted(scores.values(), key=lambda item: item[0], reverse=True)
+        return [meme for _, meme in ranked[:limit]]
+
+
+_default_registry: Optional[MemeRegistry] = None
+
+
+def get_meme_registry() -> MemeRegistry:
+    '''Registry of `ALL_MEMES` unless another one was set'''
+    global _default_registry
+    if _default_registry is None:
+        from .allmemes import ALL_MEMES
+        _default_registry = MemeRegistry(ALL_MEMES)
+    return _default_registry
+
+
+def set_meme_registry(registry: Optional[MemeRegistry]):
+    global _default_registry
+    _default_registry = registry
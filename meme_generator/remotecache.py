@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+from PIL import Image
+from .fetch import FetchedImage, ImageFetcher, get_image_fetcher
+from .singleflight import SingleFlight
+from .templates import image_nbytes
+
+log = logging.getLogger('memebot')
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_DECODED_BYTES = 64 * 1024 * 1024
+# how long a cached image is used without asking the server whether it changed
+DEFAULT_FRESH_SECONDS = 10 * 60
+
+
+def url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+class RemoteImage:
+    '''A downloaded user image, as handed from `DrawImage.prepare` to `draw`. `digest`
+    identifies the content so its decoded copy can be cached, it's None for images
+    that didn't go through a `RemoteImageCache`.'''
+    __slots__ = ('url', 'digest', 'data')
+
+    def __init__(self, url: str, digest: Optional[str], data: bytes):
+        self.url = url
+        self.digest = digest
+        self.data = data
+
+
+class _Entry:
+    __slots__ = ('url', 'digest', 'etag', 'last_modified', 'checked_at', 'size', 'data')
+
+    def __init__(self, url: str, digest: str, etag: Optional[str], last_modified: Optional[str],
+            checked_at: float, size: int, data: Optional[bytes] = None):
+        self.url = url
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.checked_at = checked_at
+        self.size = size
+        self.data = data  # only kept in memory when there's no directory
+
+    def meta(self) -> Dict:
+        return dict(url=self.url, digest=self.digest, etag=self.etag,
+            last_modified=self.last_modified, checked_at=self.checked_at)
+
+
+class RemoteImageCache:
+    '''Downloaded user images, keyed by url.
+
+    Images are stored in `directory` (or kept in memory without one), least recently
+    used first out once they take up more than `max_bytes`. A cached image is used as
+    is for `fresh_seconds` after it was last checked; after that the server is asked
+    with its ETag/Last-Modified whether it changed, and it's only downloaded again
+    if it did. Concurrent requests for the same url share one download.
+    '''
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES,
+            fresh_seconds: float = DEFAULT_FRESH_SECONDS, fetcher: Optional[ImageFetcher] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.fetcher = fetcher
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries: 'OrderedDict[str, _Entry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._singleflight = SingleFlight()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+        }
+
+    async def get(self, url: str) -> RemoteImage:
+        return await self._singleflight.do(url, lambda: self._get(url))
+
+    async def _get(self, url: str) -> RemoteImage:
+        key = url_key(url)
+        entry = self._entries.get(key)
+        data = await self._read(key, entry) if entry is not None else None
+
+        if entry is not None and data is not None:
+            if time.time() - entry.checked_at < self.fresh_seconds:
+                self.hits += 1
+                return RemoteImage(url, entry.digest, data)
+            if entry.etag or entry.last_modified:
+                fetched = await self._fetcher().fetch_conditional(url, entry.etag, entry.last_modified)
+                if fetched is None:
+                    self.revalidated += 1
+                    entry.checked_at = time.time()
+                    if self.directory:
+                        await asyncio.to_thread(self._write_meta, key, entry)
+                    return RemoteImage(url, entry.digest, data)
+                return await self._store(key, url, fetched)
+
+        self.misses += 1
+        fetched = await self._fetcher().fetch_conditional(url)
+        assert fetched is not None
+        return await self._store(key, url, fetched)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def _fetcher(self) -> ImageFetcher:
+        return self.fetcher or get_image_fetcher()
+
+    async def _read(self, key: str, entry: _Entry) -> Optional[bytes]:
+        if not self.directory:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+            return entry.data
+        return await asyncio.to_thread(self._read_disk, key)
+
+    async def _store(self, key: str, url: str, fetched: FetchedImage) -> RemoteImage:
+        entry = await asyncio.to_thread(self._write, key, url, fetched)
+        return RemoteImage(url, entry.digest, fetched.data)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        entries = []
+        for dir_entry in os.scandir(self.directory):
+            if not dir_entry.name.endswith('.json'):
+                continue
+            key = dir_entry.name[:-len('.json')]
+            try:
+                with open(dir_entry.path) as f:
+                    meta = json.load(f)
+                stat = os.stat(self._path(key))
+                entry = _Entry(size=stat.st_size, **meta)
+            except OSError:
+                continue
+            except (ValueError, TypeError):  # not json, or not the fields of an entry
+                log.warning(f'dropping cached image {key} with unreadable metadata')
+                self._remove(key)
+                continue
+            entries.append((stat.st_mtime, key, entry))
+        for _, key, entry in sorted(entries, key=lambda item: item[0]):
+            self._entries[key] = entry
+            self.nbytes += entry.size
+        log.debug(f'remote image cache found {len(self._entries)} images ({self.nbytes} bytes) in {self.directory}')
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            log.warning(f'could not read cached image {key}', exc_info=True)
+            with self._lock:
+                self._remove(key)
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return data
+
+    def _write(self, key: str, url: str, fetched: FetchedImage) -> _Entry:
+        data = fetched.data
+        entry = _Entry(url, hashlib.sha256(data).hexdigest(), fetched.etag, fetched.last_modified,
+            time.time(), len(data))
+        if len(data) > self.max_bytes:
+            return entry
+        if self.directory:
+            try:
+                temp_path = self._path(key) + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, self._path(key))
+                self._write_meta(key, entry, raise_errors=True)
+            except OSError:
+                log.warning(f'could not write image {url} to cache', exc_info=True)
+                return entry
+        else:
+            entry.data = data
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.size
+            self._entries[key] = entry
+            self.nbytes += entry.size
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def _write_meta(self, key: str, entry: _Entry, raise_errors: bool = False):
+        temp_path = self._path(key) + '.json.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(entry.meta(), f)
+            os.replace(temp_path, self._path(key) + '.json')
+        except OSError:
+            if raise_errors:
+                raise
+            log.warning(f'could not update cached image {key}', exc_info=True)
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.size
+        if self.directory:
+            for path in (self._path(key), self._path(key) + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class DecodedImageCache:
+    '''User images already decoded and reduced for a panel, keyed by (content digest,
+    panel size). Lives in each render process. Images handed out are shared, so they
+    must only be read (pasting them is fine).'''
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_DECODED_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images: 'OrderedDict[Hashable, Image.Image]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def get(self, key: Hashable) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key: Hashable, image: Image.Image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self.nbytes -= image_nbytes(previous)
+            self._images[key] = image
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted)
+
+
+_remote_image_cache: Optional[RemoteImageCache] = None
+_decoded_image_cache: Optional[DecodedImageCache] = None
+
+
+def get_remote_image_cache() -> RemoteImageCache:
+    global _remote_image_cache
+    if _remote_image_cache is None:
+        _remote_image_cache = RemoteImageCache(max_bytes=DEFAULT_MAX_MEMORY_BYTES)
+    return _remote_image_cache
+
+
+def set_remote_image_cache(cache: Optional[RemoteImageCache]):
+    global _remote_image_cache
+    _remote_image_cache = cache
+
+
+def get_decoded_image_cache() -> DecodedImageCache:
+    global _decoded_image_cache
+    if _decoded_image_cache is None:
+        _decoded_image_cache = DecodedImageCache()
+    return _decoded_image_cache
+
+
+def set_decoded_image_cache(cache: Optional[DecodedImageCache]):
+    global _decoded_image_cache
+    _decoded_image_cache = cache
@@ -0,0 +1,61 @@
+import logging
+from typing import TYPE_CHECKING, Any, List, Optional, Tuple
+from PIL import Image
+from .animation import render_animated
+from .encoding import DEFAULT_POLICY, EncodedImage, OutputPolicy, encode
+from .plan import get_plan, resolve_steps
+from .profiling import SpanRecorder
+from .templates import get_template_cache, template_is_animated, template_scale
+
+if TYPE_CHECKING:
+    from .meme import Meme
+
+log = logging.getLogger('memebot')
+
+# (index into Meme.plugins, value returned by that plugin's prepare)
+RenderSteps = List[Tuple[int, Any]]
+
+
+def render_meme(meme: 'Meme', steps: RenderSteps, policy: OutputPolicy = DEFAULT_POLICY,
+        recorder: Optional[SpanRecorder] = None) -> EncodedImage:
+    '''Decodes the template, draws every prepared step onto it and encodes the result.
+    This is the CPU-bound part of `Meme.generate` and runs inside the render executor.
+    With a `recorder`, every stage gets recorded and the spans are returned on the
+    encoded image (so they make it back from process pool workers).
+    Animated templates are rendered frame by frame by `render_animated`.'''
+    if template_is_animated(meme.image_filename):
+        return render_animated(meme, steps, policy, recorder)
+    if recorder is not None:
+        return _render_meme_profiled(meme, steps, policy, recorder)
+
+    plan_steps = get_plan(meme, template_scale(meme.image_filename, policy.max_dimension)).steps
+
+    with get_template_cache().get(meme.image_filename, policy.max_dimension) as image:  # type: Image.Image
+        for index, prepared in resolve_steps(steps):
+            plan_steps[index].draw(image, prepared)
+
+        encoded = encode(image, policy)
+
+    log.debug(f'encoded {meme.aliases[0]} as {encoded.format}: {len(encoded.data)} bytes in {encoded.encode_seconds * 1000:.1f}ms')
+    return encoded
+
+
+def _render_meme_profiled(meme: 'Meme', steps: RenderSteps, policy: OutputPolicy,
+        recorder: SpanRecorder) -> EncodedImage:
+    start = recorder.start()
+    plan_steps = get_plan(meme, template_scale(meme.image_filename, policy.max_dimension)).steps
+    image = get_template_cache().get(meme.image_filename, policy.max_dimension)
+    recorder.record('template', start)
+
+    with image:
+        for index, prepared in resolve_steps(steps):
+            start = recorder.start()
+            plan_steps[index].draw(image, prepared)
+            recorder.record('draw', start, index, plan_steps[index].plugin)
+
+        start = recorder.start()
+        encoded = encode(image, policy)
+        recorder.record('encode', start)
+
+    encoded.spans = recorder.spans
+    return encoded
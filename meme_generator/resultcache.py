@@ -0,0 +1,196 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+from .encoding import DEFAULT_POLICY, OutputPolicy
+from .templates import template_path
+
+if TYPE_CHECKING:
+    from .meme import Meme
+
+log = logging.getLogger('memebot')
+
+# bump this when rendering changes in a way that should invalidate renders cached on disk
+CACHE_VERSION = 1
+
+DEFAULT_MAX_MEMORY_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 512 * 1024 * 1024
+
+URL_REGEX = re.compile(r'https?://')
+WHITESPACE_REGEX = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    return WHITESPACE_REGEX.sub(' ', text.strip())
+
+
+def render_key(meme: 'Meme', text: str, policy: OutputPolicy = DEFAULT_POLICY) -> str:
+    '''Identifies a render by meme alias, normalized input text and a hash of the meme's
+    plugin configuration, template file and output policy'''
+    key = hashlib.sha256()
+    for part in (str(CACHE_VERSION), meme.aliases[0], normalize_text(text),
+            repr(meme.plugins), repr(_template_version(meme.image_filename)), repr(policy)):
+        key.update(part.encode())
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _template_version(image_filename: str) -> Tuple[int, int]:
+    stat = os.stat(template_path(image_filename))
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def forget_template_version(image_filename: str):
+    '''Picks up a template file that changed for render keys'''
+    _template_version.cache_clear()
+
+
+class RenderCache:
+    '''Finished renders, keyed by `render_key`.
+
+    Recent renders are kept in memory (LRU, `max_memory_bytes`). If a `directory` is
+    given, every render is also written there and the least recently used files are
+    removed once they take up more than `max_disk_bytes`.
+
+    Input containing urls is never cached since the remote image could change.
+    '''
+
+    def __init__(self, max_memory_bytes: int = DEFAULT_MAX_MEMORY_BYTES,
+            directory: Optional[str] = None, max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = directory
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory: 'OrderedDict[str, bytes]' = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: 'OrderedDict[str, int]' = OrderedDict()  # key -> file size, oldest first
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'hits': self.hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_bytes,
+            'disk_entries': len(self._disk),
+            'disk_bytes': self._disk_bytes,
+        }
+
+    def key(self, meme: 'Meme', text: str, policy: OutputPolicy = DEFAULT_POLICY) -> Optional[str]:
+        '''None if this render shouldn't be cached'''
+        if URL_REGEX.search(text):
+            return None
+        return render_key(meme, text, policy)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return data
+
+        if key in self._disk:
+            data = await asyncio.to_thread(self._read_disk, key)
+            if data is not None:
+                self.disk_hits += 1
+                self._put_memory(key, data)
+                return data
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, data: bytes):
+        self._put_memory(key, data)
+        if self.directory:
+            await asyncio.to_thread(self._write_disk, key, data)
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_bytes = 0
+        with self._disk_lock:
+            for key in list(self._disk):
+                self._remove_disk(key)
+
+    def _put_memory(self, key: str, data: bytes):
+        if len(data) > self.max_memory_bytes:
+            return
+        previous = self._memory.pop(key, None)
+        if previous is not None:
+            self._memory_bytes -= len(previous)
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load_disk_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        log.debug(f'render cache found {len(self._disk)} renders ({self._disk_bytes} bytes) in {self.directory}')
+
+    def _read_disk(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            log.warning(f'could not read cached render {key}', exc_info=True)
+            with self._disk_lock:
+                self._remove_disk(key)
+            return None
+        with self._disk_lock:
+            if key in self._disk:
+                self._disk.move_to_end(key)
+        return data
+
+    def _write_disk(self, key: str, data: bytes):
+        if len(data) > self.max_disk_bytes:
+            return
+        temp_path = self._path(key) + '.tmp'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            log.warning(f'could not write render {key} to cache', exc_info=True)
+            return
+        with self._disk_lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.max_disk_bytes:
+                self._remove_disk(next(iter(self._disk)))
+
+    def _remove_disk(self, key: str):
+        self._disk_bytes -= self._disk.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
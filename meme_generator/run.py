@@ -1,12 +1,23 @@
 import argparse
 import asyncio
+import json
 import logging
-import ptvsd
+import os
+import statistics
+import sys
+import time
 import io
+from typing import Dict, List, Optional, Tuple
 from PIL import Image
-from pygtrie import CharTrie
 from .meme import Meme
-from .allmemes import ALL_MEMES
+from .batch import BatchJob, render_batch
+from .definitions import MemeLibrary
+from .encoding import EncodedImage, OutputFormat, OutputPolicy
+from .executor import RenderExecutor
+from .farm import RenderFarm
+from .profiling import Span, SpanRecorder
+from .registry import MemeRegistry, get_meme_registry
+from .render import render_meme
 
 logging.basicConfig(format='%(asctime)s [%(name)s] [%(levelname)s] [%(filename)s:%(lineno)d]: %(message)s')
 log = logging.getLogger()
@@ -19,32 +30,187 @@ async def _run_generator(meme: Meme, text: str):
             pillow_image.show()
 
 
+async def _profile(meme: Meme, text: str, policy: OutputPolicy, repeat: int,
+        warmup: int, memory: bool) -> Tuple[EncodedImage, List[List[Span]]]:
+    '''Renders in this thread (no executor) recording every stage.
+    Warmup renders (which also fill the template and font caches) aren't returned.'''
+    runs = []
+    for i in range(warmup + repeat):
+        recorder = SpanRecorder(memory)
+        start = time.perf_counter()
+        steps = await meme.prepare(text, recorder)
+        encoded = render_meme(meme, steps, policy, recorder)
+        recorder.spans.append(Span('total', time.perf_counter() - start))
+        if i >= warmup:
+            runs.append(recorder.spans)
+    return encoded, runs
+
+
+def _print_timings(runs: List[List[Span]]):
+    phases: Dict[str, List[Span]] = {}
+    for spans in runs:
+        for span in spans:
+            phases.setdefault(span.name, []).append(span)
+    width = max(len(phase) for phase in phases)
+    memory = any(span.allocated_bytes is not None for spans in runs for span in spans)
+    print(f'{"phase":<{width}}  {"min ms":>9}  {"median ms":>9}  {"max ms":>9}' + ('  max alloc bytes' if memory else ''))
+    for phase, spans in phases.items():
+        times = [span.seconds * 1000 for span in spans]
+        allocated = [span.allocated_bytes for span in spans if span.allocated_bytes is not None]
+        print(f'{phase:<{width}}  {min(times):>9.2f}  {statistics.median(times):>9.2f}  {max(times):>9.2f}'
+            + (f'  {max(allocated):>15}' if allocated else ''))
+
+
+def peak_rss_bytes() -> Optional[int]:
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+async def _run_headless(meme: Meme, text: str, args: argparse.Namespace):
+    policy = OutputPolicy(format=OutputFormat(args.format)) if args.format else meme.output_policy()
+    encoded, runs = await _profile(meme, text, policy, args.repeat, args.warmup, args.memory)
+    _print_timings(runs)
+    print(f'output: {encoded.format}, {len(encoded.data)} bytes')
+    peak_rss = peak_rss_bytes()
+    if peak_rss is not None:
+        print(f'peak rss: {peak_rss / (1024 * 1024):.1f} MB')
+    if args.output:
+        _write_file(args.output, encoded.data)
+        print(f'wrote {args.output}')
+
+
+def _find_meme(memes: MemeRegistry, command: str) -> Tuple[Optional[Meme], str]:
+    '''meme the command starts with and the text after its alias'''
+    match = memes.resolve(command.strip())
+    if match is None:
+        return None, ''
+    return match.meme, match.text
+
+
+def load_jobs(path: str, memes: MemeRegistry) -> List[BatchJob]:
+    '''Reads a jsonl file with one job per line, either {"command": "uno draw 25 / me"}
+    or {"meme": "uno", "text": "draw 25 / me"}, optionally with an "id"
+    (the line number by default).'''
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            if 'command' in job:
+                meme, text = _find_meme(memes, job['command'])
+            else:
+                meme, text = memes.get(job['meme']), job.get('text', '')
+            if meme is None:
+                raise ValueError(f'{path}:{line_number}: no such meme found')
+            jobs.append(BatchJob(str(job.get('id', line_number)), meme, text))
+    return jobs
+
+
+async def _run_batch(jobs: List[BatchJob], out_dir: str, executor: RenderExecutor) -> int:
+    '''Renders the jobs into `out_dir`, printing a json line per finished job. Returns the number of failures.'''
+    os.makedirs(out_dir, exist_ok=True)
+    failures = 0
+    start = time.perf_counter()
+    async for result in render_batch(jobs, executor=executor):
+        report = dict(id=result.job.id, meme=result.job.meme.aliases[0], seconds=round(result.seconds, 4))
+        if result.error is not None:
+            failures += 1
+            report['error'] = repr(result.error)
+        else:
+            path = os.path.join(out_dir, f'{result.job.id}.{result.encoded.extension}')
+            await asyncio.to_thread(_write_file, path, result.encoded.data)
+            report.update(path=path, bytes=len(result.encoded.data))
+        print(json.dumps(report), flush=True)
+    elapsed = time.perf_counter() - start
+    log.info(f'rendered {len(jobs) - failures}/{len(jobs)} memes in {elapsed:.2f}s ({len(jobs) / elapsed:.1f}/s)')
+    return failures
+
+
+def _write_file(path: str, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _count(minimum: int):
+    '''argparse type for an int that is at least `minimum`'''
+    def parse(value: str) -> int:
+        count = int(value)
+        if count < minimum:
+            raise argparse.ArgumentTypeError(f'must be at least {minimum}, got {count}')
+        return count
+    parse.__name__ = 'int'  # shown in argparse's "invalid int value" errors
+    return parse
+
+
 def run_meme():
     parser = argparse.ArgumentParser()
-    parser.add_argument('command',  nargs='+', help="meme command. this does not need '!meme'")
-    parser.add_argument('-w', '--wait', action='store_true', default=False)
+    parser.add_argument('command',  nargs='*', help="meme command. this does not need '!meme'")
+    parser.add_argument('-o', '--output', metavar='PATH', help='write the meme here instead of opening a viewer')
+    parser.add_argument('-f', '--format', choices=[output_format.value for output_format in OutputFormat],
+        help="output format (default: the meme's own)")
+    parser.add_argument('-n', '--repeat', type=_count(1), default=1, help='renders to time')
+    parser.add_argument('--warmup', type=_count(0), default=0, metavar='N',
+        help='untimed renders to run first, to fill caches')
+    parser.add_argument('--memory', action='store_true', default=False,
+        help='also trace python allocations per phase (slows rendering down)')
+    parser.add_argument('-d', '--debug', action='store_true', default=False, help='let a debugger attach (ptvsd)')
+    parser.add_argument('-w', '--wait', action='store_true', default=False, help='wait for a debugger to attach')
+    parser.add_argument('--meme-dir', metavar='DIR', help='also use the memes defined in data files in this directory')
+    parser.add_argument('--batch', metavar='JOBS', help='render every job in a jsonl file instead of a single command')
+    parser.add_argument('--out', metavar='DIR', default='.', help='directory batch renders are written to')
+    parser.add_argument('--pool', choices=('thread', 'process', 'farm'), default='process',
+        help='where batch renders run (default: process)')
+    parser.add_argument('--workers', type=int, default=None, help='batch render workers (default: cpu count)')
     args = parser.parse_args()
 
     log.debug(f'debug args: {args}')
 
-    ptvsd.enable_attach()
-    if args.wait:
-        ptvsd.wait_for_attach()
+    # same alias lookup as the bot
+    memes = get_meme_registry()
+    if args.meme_dir:
+        library = MemeLibrary(args.meme_dir)
+        rejected = memes.update(library.reload())
+        for meme in rejected:
+            log.error(f'{meme.aliases[0]} from {args.meme_dir} uses an alias that is already taken')
+
+    if args.batch:
+        log.setLevel(logging.INFO)
+        jobs = load_jobs(args.batch, memes)
+        workers = args.workers or os.cpu_count()
+        executor = (RenderFarm(max_workers=workers) if args.pool == 'farm'
+            else RenderExecutor(kind=args.pool, max_workers=workers))
+        try:
+            failures = asyncio.run(_run_batch(jobs, args.out, executor))
+        finally:
+            executor.shutdown(wait=True)
+        sys.exit(1 if failures else 0)
 
-    # create dict of memes
-    # TODO: have this work closer to how it works in memebot.py
-    memes = CharTrie()
-    for meme in ALL_MEMES:
-        for alias in meme.aliases:
-            memes[alias] = meme
+    if not args.command:
+        parser.error('a meme command or --batch is required')
+
+    if args.debug or args.wait:
+        import ptvsd
+        ptvsd.enable_attach()
+        if args.wait:
+            ptvsd.wait_for_attach()
 
     # run given meme
-    command = ' '.join(args.command).strip()
-    alias, meme = memes.longest_prefix(command)
-    if not alias or not meme:
-        log.error('no such meme found')
+    meme, text = _find_meme(memes, ' '.join(args.command))
+    if not meme:
+        suggestions = memes.suggest(' '.join(args.command))
+        log.error('no such meme found' + (f', did you mean: {", ".join(meme.aliases[0] for meme in suggestions)}'
+            if suggestions else ''))
         exit(1)
 
-    text = command[len(alias):].strip()
-    asyncio.run(_run_generator(meme, text))
-
+    if args.output or args.format or args.repeat > 1 or args.warmup or args.memory:
+        # debug logs for every plugin would end up in the timings
+        log.setLevel(logging.INFO)
+        asyncio.run(_run_headless(meme, text, args))
+    else:
+        asyncio.run(_run_generator(meme, text))
@@ -0,0 +1,108 @@
+import asyncio
+import concurrent.futures
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+from .plan import SKIPPED, PlanStep
+from .plugins import USER_INPUT_KEY
+from .profiling import SpanRecorder
+from .render import RenderSteps
+
+log = logging.getLogger('memebot')
+
+
+class PrepareSchedule:
+    '''Runs the prepare steps of a meme's render plan for one input, see `Meme.prepare`.
+
+    `start` prepares plugins in order, except that I/O bound ones (and any waiting on
+    them) are left running in the background, so e.g. the images of a meme download at
+    the same time. A plugin only starts once the ones it depends on (see `RenderPlan`)
+    are done. `wait` waits for the background ones, `close` cancels whatever's left.
+    '''
+    __slots__ = ('plan_steps', 'context', 'recorder', 'prepared', 'tasks')
+
+    def __init__(self, plan_steps: Sequence[PlanStep], text: str, recorder: Optional[SpanRecorder] = None):
+        self.plan_steps = plan_steps
+        self.context = {USER_INPUT_KEY: text}
+        self.recorder = recorder
+        # index -> prepared value of the steps that draw
+        self.prepared: Dict[int, Any] = {}
+        self.tasks: Dict[int, asyncio.Task] = {}
+
+    async def start(self):
+        for index, step in enumerate(self.plan_steps):
+            waiting = [self.tasks[earlier] for earlier in step.depends if earlier in self.tasks]
+            pending = [task for task in waiting if not task.done()]
+            if pending:
+                self.tasks[index] = asyncio.create_task(self._prepare_after(pending, index, step))
+                continue
+            for task in waiting:
+                task.result()  # raises if it failed
+            input_text = self._read_input(step)
+            if input_text is None:
+                continue
+            if step.io_bound:
+                self.tasks[index] = asyncio.create_task(self._prepare_step(index, step, input_text))
+            else:
+                await self._prepare_step(index, step, input_text)
+
+    async def wait(self):
+        if self.tasks:
+            await asyncio.wait(self.tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            for index in sorted(self.tasks):
+                if self.tasks[index].done():
+                    self.tasks[index].result()  # raises the error of the first plugin that failed
+
+    def steps(self) -> RenderSteps:
+        '''The prepared steps, once `wait` is done'''
+        return [(index, self.prepared[index]) for index in sorted(self.prepared)]
+
+    def deferred_steps(self) -> RenderSteps:
+        '''The steps so far, with concurrent futures standing in for the ones still being
+        prepared in the background (see `resolve_steps`). Lets a render in a thread get
+        going before downloads are done.'''
+        futures: Dict[int, concurrent.futures.Future] = {}
+        for index, task in self.tasks.items():
+            if self.plan_steps[index].draws:
+                futures[index] = future = concurrent.futures.Future()
+                task.add_done_callback(lambda task, index=index, future=future: self._resolve(index, task, future))
+        return [(index, futures[index] if index in futures else self.prepared[index])
+            for index in sorted(set(self.prepared) | set(futures))]
+
+    def close(self):
+        for task in self.tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # plugins waiting on a failed one fail with its error too
+
+    def _resolve(self, index: int, task: asyncio.Task, future: concurrent.futures.Future):
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(self.prepared.get(index, SKIPPED))
+
+    async def _prepare_after(self, pending: List[asyncio.Task], index: int, step: PlanStep):
+        await asyncio.gather(*pending)
+        input_text = self._read_input(step)
+        if input_text is not None:
+            await self._prepare_step(index, step, input_text)
+
+    def _read_input(self, step: PlanStep) -> Optional[str]:
+        input_text = step.read_input(self.context)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'Plugin input text: {input_text}, context: {self.context}, plugin: {step.plugin!r}')
+        if input_text is None and step.required:
+            raise ValueError(f'Missing input for required plugin: {step.plugin}')
+        return input_text
+
+    async def _prepare_step(self, index: int, step: PlanStep, input_text: str):
+        if self.recorder is None:
+            result = await step.plugin.prepare(input_text, self.context)
+        else:
+            start = self.recorder.start()
+            result = await step.plugin.prepare(input_text, self.context)
+            self.recorder.record('prepare', start, index, step.plugin)
+        if step.draws:
+            self.prepared[index] = result
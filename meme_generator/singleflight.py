@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+log = logging.getLogger('memebot')
+
+T = TypeVar('T')
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''Coalesces concurrent calls that share a key.
+
+    The first caller for a key starts `func` in its own task, and everyone else calling
+    with that key while it runs waits on that same task, getting the same result or
+    exception. A caller being cancelled doesn't cancel the work for the others; the work
+    is only cancelled once every caller waiting on it has been.
+    '''
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda task: self._finish(key, call))
+        else:
+            log.debug(f'joining in flight call for {key}')
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                # new callers shouldn't join a cancelled call
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+    def _finish(self, key: Hashable, call: _Call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        # everyone may have stopped waiting already, don't leave the exception unretrieved
+        if not call.task.cancelled():
+            call.task.exception()
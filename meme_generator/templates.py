@@ -0,0 +1,166 @@
+import functools
+import logging
+import os.path
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Optional, Tuple, Union
+from PIL import Image
+
+# this will be something like ../memebot/meme_generator
+module_path = os.path.dirname(os.path.abspath(__file__))
+package_root_dir = str(Path(module_path).parents[0])
+
+log = logging.getLogger('memebot')
+
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+# templates are rendered scaled down to fit this many pixels on their longest side
+DEFAULT_MAX_DIMENSION = 1024
+
+# (image_filename, max_dimension), max_dimension is None for the template at full size
+TemplateKey = Tuple[str, Optional[int]]
+
+
+def template_path(image_filename: str) -> str:
+    return os.path.join(package_root_dir, 'assets', image_filename)
+
+
+@functools.lru_cache(maxsize=None)
+def template_size(image_filename: str) -> Tuple[int, int]:
+    '''size the template was authored at, only reads the file header'''
+    with Image.open(template_path(image_filename)) as image:
+        return image.size
+
+
+@functools.lru_cache(maxsize=None)
+def template_is_animated(image_filename: str) -> bool:
+    '''whether the template has more than one frame (GIF or APNG), only reads the file header'''
+    with Image.open(template_path(image_filename)) as image:
+        return getattr(image, 'is_animated', False)
+
+
+def template_scale(image_filename: str, max_dimension: Optional[int]) -> float:
+    '''How much a template gets scaled down to fit in `max_dimension`. Memes are defined
+    at the authored size and their plugins get scaled by this much (see `BasePlugin.scaled`).'''
+    if not max_dimension:
+        return 1.0
+    return min(1.0, max_dimension / max(template_size(image_filename)))
+
+
+def image_nbytes(image: Image.Image) -> int:
+    '''rough size of the decoded pixel data'''
+    bits_per_pixel = {'1': 1, 'I;16': 16, 'I': 32, 'F': 32}.get(image.mode, 8 * len(image.getbands()))
+    return image.size[0] * image.size[1] * bits_per_pixel // 8
+
+
+class TemplateCache:
+    '''Decoded template images, keyed by `Meme.image_filename` and resolution tier.
+
+    With `max_dimension`, templates larger than that are kept scaled down to fit
+    (JPEGs are decoded at reduced size to begin with). Least recently used tiers are
+    evicted once the cache holds more than `max_bytes` of pixel data. `get` hands out
+    a copy, so callers are free to draw on it. Safe to share between render threads.
+    '''
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._images: 'OrderedDict[TemplateKey, Image.Image]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key: Union[str, TemplateKey]):
+        if isinstance(key, str):
+            key = (key, None)
+        return key in self._images
+
+    def get(self, image_filename: str, max_dimension: Optional[int] = None) -> Image.Image:
+        key = self._key(image_filename, max_dimension)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+
+        if image is None:
+            image = self._load(*key)
+            self._put(key, image)
+
+        template = image.copy()
+        template.format = image.format
+        return template
+
+    def warm(self, image_filenames: Iterable[str], max_dimension: Optional[int] = None):
+        for image_filename in image_filenames:
+            key = self._key(image_filename, max_dimension)
+            if key not in self:
+                self._put(key, self._load(*key))
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def discard(self, image_filename: str):
+        '''Drops every tier of a template, e.g. after the file changed'''
+        with self._lock:
+            for key in [key for key in self._images if key[0] == image_filename]:
+                self.nbytes -= image_nbytes(self._images.pop(key))
+
+    def _key(self, image_filename: str, max_dimension: Optional[int]) -> TemplateKey:
+        # templates that already fit share the full size entry
+        if template_scale(image_filename, max_dimension) == 1.0:
+            return (image_filename, None)
+        return (image_filename, max_dimension)
+
+    def _load(self, image_filename: str, max_dimension: Optional[int]) -> Image.Image:
+        with Image.open(template_path(image_filename)) as image:
+            if max_dimension is None:
+                image.load()
+                return image
+            scale = template_scale(image_filename, max_dimension)
+            size = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+            image.draft(image.mode, size)
+            scaled = image.resize(size, Image.LANCZOS)
+            scaled.format = image.format
+            log.debug(f'scaled template {image_filename} from {template_size(image_filename)} to {size}')
+            return scaled
+
+    def _put(self, key: TemplateKey, image: Image.Image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self.nbytes -= image_nbytes(previous)
+            self._images[key] = image
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                evicted_key, evicted = self._images.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted)
+                log.debug(f'evicted template {evicted_key} from cache')
+
+
+_template_cache: Optional[TemplateCache] = None
+
+
+def get_template_cache() -> TemplateCache:
+    global _template_cache
+    if _template_cache is None:
+        _template_cache = TemplateCache()
+    return _template_cache
+
+
+def set_template_cache(cache: Optional[TemplateCache]):
+    global _template_cache
+    _template_cache = cache
+
+
+def forget_template(image_filename: str):
+    '''Makes the next render read the template file again'''
+    template_size.cache_clear()
+    template_is_animated.cache_clear()
+    get_template_cache().discard(image_filename)
@@ -1,7 +1,15 @@
+import asyncio
+import logging
 import discord
 import pygtrie
 from discord.ext import commands
-from meme_generator import ALL_MEMES, Meme as MemeGenerator
+from typing import Dict, Optional
+from meme_generator import (ImageFetcher, Meme as MemeGenerator, MemeChanges, MemeLibrary, MemeRegistry,
+    MemeRegistryError, OutputPolicy, Profile, RemoteImageCache, RenderCache, RenderExecutor, RenderFarm, SingleFlight,
+    StageStats, compile_all, get_meme_registry, set_image_fetcher, set_remote_image_cache)
+
+
+log = logging.getLogger('memebot')
 
 
 class MemeGroup(commands.Group):
@@ -11,25 +19,133 @@ class MemeGroup(commands.Group):
 
 
 class Meme(commands.Cog):
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, render_executor: Optional[RenderExecutor] = None,
+            render_cache: Optional[RenderCache] = None, warm_templates: bool = False,
+            output_policy: Optional[OutputPolicy] = None, image_fetcher: Optional[ImageFetcher] = None,
+            remote_image_cache: Optional[RemoteImageCache] = None, render_profile: Optional[Profile] = None,
+            meme_library: Optional[MemeLibrary] = None, meme_reload_seconds: float = 0,
+            registry: Optional[MemeRegistry] = None):
         super().__init__()
+        self.render_executor = render_executor or RenderExecutor()
+        self.render_cache = render_cache
+        self.output_policy = output_policy
+        # plugins download user images through the default fetcher
+        self.image_fetcher = image_fetcher or ImageFetcher()
+        set_image_fetcher(self.image_fetcher)
+        self.remote_image_cache = remote_image_cache or RemoteImageCache(max_bytes=64 * 1024 * 1024)
+        set_remote_image_cache(self.remote_image_cache)
+        self.singleflight = SingleFlight()
+        self.render_profile = render_profile
+        # every meme by alias, shared with the bot's get_context
+        self.registry = registry or get_meme_registry()
+        # memes defined in data files, they come and go as the files change
+        self.meme_library = meme_library
+        self.meme_reload_seconds = meme_reload_seconds
+        # id(meme) -> its command
+        self._commands: Dict[int, commands.Command] = {}
+        self._reload_task: Optional[asyncio.Task] = None
+        self.warm_templates = warm_templates
         self.meme.all_commands = pygtrie.CharTrie(self.meme.all_commands)
 
-        for meme_generator in ALL_MEMES:
-            _create_meme_command(self.meme, meme_generator)
+        compile_all(self.registry.memes)
+        for meme_generator in self.registry.memes:
+            self._commands[id(meme_generator)] = _create_meme_command(self, meme_generator)
+
+    async def cog_load(self):
+        if isinstance(self.render_executor, RenderFarm):
+            self.render_executor.start_health_checks()
+        if self.warm_templates:
+            await self.render_executor.warm(self.registry.memes, self.output_policy)
+        if self.meme_library:
+            await self.reload_memes()
+            if self.meme_reload_seconds:
+                self._reload_task = asyncio.create_task(self._reload_loop())
+
+    async def cog_unload(self):
+        if self._reload_task is not None:
+            self._reload_task.cancel()
+        self.render_executor.shutdown()
+        await self.image_fetcher.close()
+
+    async def reload_memes(self) -> MemeChanges:
+        '''Rereads meme definition files that changed, only replacing the commands of memes that changed'''
+        changes = await asyncio.to_thread(self.meme_library.reload)
+        for meme_generator in changes.removed:
+            self.registry.remove(meme_generator)
+            command = self._commands.pop(id(meme_generator), None)
+            if command is not None:
+                self.meme.remove_command(command.name)
+        for meme_generator in changes.added:
+            try:
+                self.registry.add(meme_generator)
+                self._commands[id(meme_generator)] = _create_meme_command(self, meme_generator)
+            except (MemeRegistryError, commands.CommandRegistrationError) as e:
+                self.registry.remove(meme_generator)
+                log.error(f'could not add meme {meme_generator.aliases[0]}: {e}')
+        if changes:
+            log.info(f'reloaded memes: {changes!r}')
+        return changes
+
+    async def _reload_loop(self):
+        while True:
+            await asyncio.sleep(self.meme_reload_seconds)
+            try:
+                await self.reload_memes()
+            except Exception:
+                log.exception('reloading memes failed')
 
     @commands.group(cls=MemeGroup, aliases=['memelist', 'meme list'])
     async def meme(self, context: commands.Context):
         '''list memes'''
-        if not context.invoked_subcommand:
+        if context.invoked_subcommand:
+            return
+        # no meme matched, if it looks like a typo suggest the memes it might have been
+        text = context.message.content[len(context.prefix or '') + len(context.invoked_with or ''):].strip()
+        suggestions = self.registry.suggest(text) if text else []
+        if not suggestions:
             return await context.send_help(self.meme)
+        embed = discord.Embed(title='No such meme, did you mean:')
+        for suggestion in suggestions:
+            embed.add_field(name=f'{context.prefix}meme {suggestion.aliases[0]}', value=suggestion.help_string, inline=False)
+        await context.send(embed=embed)
+
+    def command_for(self, meme_generator: MemeGenerator) -> Optional[commands.Command]:
+        return self._commands.get(id(meme_generator))
+
+    @meme.command(name='reload', hidden=True)
+    @commands.is_owner()
+    async def reload(self, context: commands.Context):
+        '''reload memes defined in data files'''
+        if not self.meme_library:
+            return await context.send('no meme definition directory configured')
+        changes = await self.reload_memes()
+        await context.send(f'{len(changes.added)} memes added, {len(changes.removed)} removed')
+
+    @meme.command(name='stats', hidden=True)
+    @commands.is_owner()
+    async def stats(self, context: commands.Context):
+        '''render and remote image cache stats, and the slowest render stages when profiling'''
+        stats = [f'remote_image_{name}: {value}' for name, value in self.remote_image_cache.stats().items()]
+        if self.render_cache:
+            stats = [f'{name}: {value}' for name, value in self.render_cache.stats().items()] + stats
+        else:
+            stats.insert(0, 'render cache disabled')
+        for observer in (self.render_profile.observers if self.render_profile else []):
+            if isinstance(observer, StageStats):
+                stats.append('slowest render stages:')
+                stats.extend(f'{alias} {name}: {stage["count"]} renders, {stage["total_seconds"]:.2f}s total, '
+                    f'{stage["max_seconds"] * 1000:.1f}ms max' for alias, name, stage in observer.slowest())
+        stats_text = '\n'.join(stats)
+        await context.send(f'```{stats_text}```')
 
 
-def _create_meme_command(group: commands.Group, meme_generator: MemeGenerator):
+def _create_meme_command(cog: Meme, meme_generator: MemeGenerator) -> commands.Command:
     generator_name = meme_generator.aliases[0].replace(' ', '_') + '_executor'
-    @group.command(help=meme_generator.help_string, name=generator_name, aliases=meme_generator.aliases)
+    @cog.meme.command(help=meme_generator.help_string, name=generator_name, aliases=meme_generator.aliases)
     async def meme_executor(context: commands.Context, *, text: str):
         async with context.typing():
-            async with meme_generator.generate(text) as meme_image:
-                df = discord.File(meme_image, filename=meme_generator.image_filename)
+            async with meme_generator.generate(text, executor=cog.render_executor, cache=cog.render_cache,
+                    singleflight=cog.singleflight, policy=cog.output_policy, profile=cog.render_profile) as meme_image:
+                df = discord.File(meme_image, filename=meme_image.name)
                 return await context.send(file=df)
+    return meme_executor
@@ -5,7 +5,10 @@ import discordhealthcheck
 from discord.ext import commands
 from discord.ext.commands.view import StringView
 from pygtrie import CharTrie
-from typing import Dict, Iterable, Callable, Awaitable, Optional, MutableMapping, Tuple, Mapping, List
+from typing import Any, Dict, Iterable, Callable, Awaitable, Optional, MutableMapping, Tuple, Mapping, List
+from meme_generator import (ImageFetcher, MemeLibrary, OutputFormat, OutputPolicy, Profile,
+    RemoteImageCache, RenderCache, RenderExecutor, RenderFarm, SlowRenderLogger, StageStats, TemplateCache,
+    get_meme_registry, set_template_cache)
 from .guildconfig import get_guild_config_dict
 from .cogs import Quote, OutOfContext, ChatStats, RollDice, Player, Beans, Meme, Meta, TarotCard, WolframAlpha, Suggest, Reminder, Hey, Whisper, Calendar, ChatGPT
 from .cogs.meme import MemeGroup
@@ -27,12 +30,103 @@ log = logging.getLogger('memebot')
 log.setLevel(logging.DEBUG)
 
 
+def get_render_executor_from_env() -> RenderExecutor:
+    kind = os.getenv('MEME_BOT_RENDER_POOL', 'thread')
+    options = dict(
+        max_workers=int(os.getenv('MEME_BOT_RENDER_WORKERS', '0')) or None,
+        max_concurrency=int(os.getenv('MEME_BOT_RENDER_CONCURRENCY', '0')) or None,
+        timeout=float(os.getenv('MEME_BOT_RENDER_TIMEOUT', '0')) or None,
+    )
+    template_cache_bytes = int(os.getenv('MEME_BOT_TEMPLATE_CACHE_BYTES', str(128 * 1024 * 1024)))
+    if kind == 'farm':
+        return RenderFarm(
+            max_jobs_per_worker=int(os.getenv('MEME_BOT_RENDER_FARM_MAX_JOBS', '200')) or None,
+            template_cache_bytes=template_cache_bytes,
+            **options)
+    set_template_cache(TemplateCache(max_bytes=template_cache_bytes))
+    return RenderExecutor(kind=kind, **options)
+
+
+def get_render_cache_from_env() -> Optional[RenderCache]:
+    memory_bytes = int(os.getenv('MEME_BOT_RENDER_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024)))
+    directory = os.getenv('MEME_BOT_RENDER_CACHE_DIR') or None
+    if not memory_bytes and not directory:
+        return None
+    return RenderCache(
+        max_memory_bytes=memory_bytes,
+        directory=directory,
+        max_disk_bytes=int(os.getenv('MEME_BOT_RENDER_CACHE_DISK_BYTES', str(512 * 1024 * 1024))))
+
+
+def get_output_policy_from_env() -> Optional[OutputPolicy]:
+    '''Encoding for every meme, under the options a meme's own output policy sets. Only the
+    options given here get set, so the rest stay as Pillow's (or the meme's) defaults.'''
+    options: Dict[str, Any] = {}
+    output_format = os.getenv('MEME_BOT_OUTPUT_FORMAT')
+    if output_format:
+        options['format'] = OutputFormat(output_format)
+    quality = int(os.getenv('MEME_BOT_OUTPUT_QUALITY', '0')) or None
+    if quality:
+        options['quality'] = quality
+    for option in ('optimize', 'progressive'):
+        value = os.getenv(f'MEME_BOT_OUTPUT_{option.upper()}')
+        if value:
+            options[option] = value.lower() in ('1', 'true')
+    png_compress_level = os.getenv('MEME_BOT_OUTPUT_PNG_COMPRESS_LEVEL')
+    if png_compress_level:
+        options['png_compress_level'] = int(png_compress_level)
+    max_bytes = int(os.getenv('MEME_BOT_OUTPUT_MAX_BYTES', '0')) or None
+    if max_bytes:
+        options['max_bytes'] = max_bytes
+    max_dimension = os.getenv('MEME_BOT_OUTPUT_MAX_DIMENSION')
+    if max_dimension:
+        # 0 renders templates at full size
+        options['max_dimension'] = int(max_dimension) or None
+    return OutputPolicy(**options) if options else None
+
+
+def get_image_fetcher_from_env() -> ImageFetcher:
+    return ImageFetcher(
+        max_bytes=int(os.getenv('MEME_BOT_IMAGE_MAX_BYTES', str(16 * 1024 * 1024))),
+        connect_timeout=float(os.getenv('MEME_BOT_IMAGE_CONNECT_TIMEOUT', '5')),
+        read_timeout=float(os.getenv('MEME_BOT_IMAGE_READ_TIMEOUT', '10')))
+
+
+def get_remote_image_cache_from_env() -> RemoteImageCache:
+    directory = os.getenv('MEME_BOT_REMOTE_IMAGE_CACHE_DIR') or None
+    default_bytes = 256 * 1024 * 1024 if directory else 64 * 1024 * 1024
+    return RemoteImageCache(
+        directory=directory,
+        max_bytes=int(os.getenv('MEME_BOT_REMOTE_IMAGE_CACHE_BYTES', str(default_bytes))),
+        fresh_seconds=float(os.getenv('MEME_BOT_REMOTE_IMAGE_FRESH_SECONDS', '600')))
+
+
+def get_render_profile_from_env() -> Optional[Profile]:
+    '''MEME_BOT_RENDER_PROFILE=time logs slow renders stage by stage and keeps per stage
+    totals for the meme stats command, =memory traces allocations too'''
+    mode = os.getenv('MEME_BOT_RENDER_PROFILE', '').lower()
+    if mode not in ('time', 'memory'):
+        return None
+    return Profile(
+        SlowRenderLogger(min_seconds=float(os.getenv('MEME_BOT_SLOW_RENDER_SECONDS', '1'))),
+        StageStats(),
+        memory=mode == 'memory')
+
+
+def get_meme_library_from_env() -> Optional[MemeLibrary]:
+    '''Memes defined in data files in MEME_BOT_MEME_DIR, on top of the built in ones'''
+    directory = os.getenv('MEME_BOT_MEME_DIR')
+    return MemeLibrary(directory) if directory else None
+
+
 class MemeBot(commands.Bot):
 
     def __init__(self, command_prefix, help_command=EmbedHelpCommand(), description=None, **options):
         super().__init__(command_prefix, help_command=help_command, description=description, **options)
         # make sure this is a Trie
         self.all_commands = CharTrie(self.all_commands)
+        # memes by alias, looked up in get_context and kept up to date by the Meme cog
+        self.meme_registry = get_meme_registry()
 
     async def setup_hook(self):
         # cogs setup
@@ -44,7 +138,18 @@ class MemeBot(commands.Bot):
         await self.add_cog(ChatStats())
         await self.add_cog(RollDice(int(x) for x in os.getenv('MEME_BOT_UNLUCKY_ROLL_IDS', '').split(',') if x))
         await self.add_cog(Player(self, config))
-        await self.add_cog(Meme(self))
+        await self.add_cog(Meme(self,
+            render_executor=get_render_executor_from_env(),
+            render_cache=get_render_cache_from_env(),
+            warm_templates=os.getenv('MEME_BOT_WARM_TEMPLATES', '').lower() in ('1', 'true'),
+            output_policy=get_output_policy_from_env(),
+            image_fetcher=get_image_fetcher_from_env(),
+            remote_image_cache=get_remote_image_cache_from_env(),
+            render_profile=get_render_profile_from_env(),
+            meme_library=get_meme_library_from_env(),
+            # how often the meme definition files are checked for changes, 0 only reloads on !meme reload
+            meme_reload_seconds=float(os.getenv('MEME_BOT_MEME_RELOAD_SECONDS', '5')),
+            registry=self.meme_registry))
         await self.add_cog(Beans())
         await self.add_cog(Meta(self, config, LOG_FILE))
         await self.add_cog(WolframAlpha(os.getenv('MEME_BOT_WOLFRAM_ALPHA_KEY', '')))
@@ -95,10 +200,18 @@ class MemeBot(commands.Bot):
             full_string = context.prefix + alias if alias else None
         if isinstance(context.command, MemeGroup):
             group = context.command
-            no_prefix_content = message.content[len(context.prefix):]
-            no_group_content = no_prefix_content[len(group.qualified_name) + 1:]  # assume single space after group name
-            alias, new_command = group.all_commands.longest_prefix(no_group_content)
-            full_string = context.prefix + group.qualified_name + ' ' + alias if alias else None
+            group_end = len(context.prefix) + len(group.qualified_name) + 1  # assume single space after group name
+            # memes are matched ignoring case and spacing, so what got matched is sliced out of the message as is
+            match = self.meme_registry.resolve(message.content[group_end:])
+            meme_cog = self.get_cog('Meme')
+            if match and meme_cog:
+                new_command = meme_cog.command_for(match.meme)
+                alias = message.content[group_end:group_end + match.end].strip()
+                full_string = message.content[:group_end + match.end]
+            else:
+                # other subcommands of the group (stats, reload)
+                alias, new_command = group.all_commands.longest_prefix(message.content[group_end:])
+                full_string = context.prefix + group.qualified_name + ' ' + alias if alias else None
         if new_command and alias and full_string:
             context.command = new_command
             context.invoked_with = alias
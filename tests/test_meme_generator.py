@@ -0,0 +1,714 @@
+import asyncio
+import io
+import itertools
+import os
+import threading
+import time
+import types
+from concurrent.futures.process import BrokenProcessPool
+from typing import ClassVar, Dict, Optional, Tuple
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from PIL import Image, ImageDraw
+from meme_generator import (ALL_MEMES, DEFAULT_MAX_DIMENSION, FetchError, FontRegistry, ImageFetcher, LayoutCache,
+    Meme, MemeDefinitionError, MemeLibrary, MemeRegistry, MemeRegistryError, OutputFormat, OutputPolicy, Profile,
+    RemoteImageCache, RenderCache, RenderExecutor, RenderFarm, SingleFlight, TemplateCache, encode, get_font_registry,
+    get_plan, parse_meme, set_font_registry, set_layout_cache)
+from meme_generator.animation import FrameUpdate, write_gif
+from meme_generator.batch import BatchJob, group_by_template, render_batch
+from meme_generator.plugins import (AutoPosition, BasePlugin, ContextInput, Coordinate, DrawText, OutlineMode, SplitText,
+    TextStyle, UserInput)
+from meme_generator.plugins import drawimage
+from meme_generator.plugins.drawimage import ImageDecodeError, decode_image
+from meme_generator.plugins.drawtext import MAX_FIT_ITERATIONS, stroke_width, wrap_to_width
+from meme_generator.templates import image_nbytes, template_path, template_scale, template_size
+
+
+@pytest.fixture
+def executor():
+    executor = RenderExecutor(kind='thread', max_workers=1, max_concurrency=1)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+@pytest.mark.asyncio
+async def test_executor_runs_off_loop(executor: RenderExecutor):
+    assert await executor.run(threading.get_ident) != threading.get_ident()
+
+
+@pytest.mark.asyncio
+async def test_executor_cancel_queued_job(executor: RenderExecutor):
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    ran = []
+    first = asyncio.create_task(executor.run(block))
+    second = asyncio.create_task(executor.run(ran.append, 1))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+    second.cancel()
+    release.set()
+    await first
+    with pytest.raises(asyncio.CancelledError):
+        await second
+    assert ran == []
+
+
+def test_executor_rejects_unknown_kind():
+    with pytest.raises(ValueError):
+        RenderExecutor(kind='fiber')
+
+
+@pytest.mark.asyncio
+async def test_render_farm_falls_back_when_pool_breaks():
+    farm = RenderFarm(max_workers=1)
+    uno = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'uno')
+    steps = await uno.prepare('draw 25 / me')
+    try:
+        with pytest.raises(BrokenProcessPool):
+            await farm.run(os._exit, 1)
+        # rendered in process while the pool gets replaced, then by the new pool
+        assert (await farm.render(uno, steps)).format == 'JPEG'
+        assert (await farm.render(uno, steps)).format == 'JPEG'
+        assert farm.healthy
+    finally:
+        farm.shutdown(wait=True)
+
+
+@pytest.mark.asyncio
+async def test_render_farm_recovers_after_timeouts():
+    # workers can't even start up this fast
+    farm = RenderFarm(max_workers=1, timeout=0.001, health_check_timeout=0.001)
+    uno = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'uno')
+    steps = await uno.prepare('draw 25 / me')
+    try:
+        assert (await farm.render(uno, steps)).format == 'JPEG'
+        assert not farm.healthy
+        assert not await farm.check_health()
+
+        farm.health_check_timeout = 30
+        assert await farm.check_health()
+        farm.timeout = 30
+        assert (await farm.render(uno, steps)).format == 'JPEG'
+        assert farm.healthy
+    finally:
+        farm.shutdown(wait=True)
+
+
+def test_template_cache_evicts_least_recently_used():
+    uno_bytes = image_nbytes(Image.open(template_path('uno.jpg')))
+    cache = TemplateCache(max_bytes=uno_bytes * 2)
+    cache.warm(['uno.jpg', 'spongebob.jpg'])
+    cache.get('uno.jpg')
+    cache.get('boromir.jpg')
+    assert 'uno.jpg' in cache
+    assert 'spongebob.jpg' not in cache
+    assert cache.nbytes <= cache.max_bytes
+
+
+def test_template_cache_returns_copies():
+    cache = TemplateCache()
+    template = cache.get('uno.jpg')
+    assert template.format == 'JPEG'
+    template.paste((255, 0, 0), box=(0, 0, 10, 10))
+    assert cache.get('uno.jpg').getpixel((0, 0)) != (255, 0, 0)
+
+
+def test_template_cache_scales_large_templates():
+    cache = TemplateCache()
+    assert cache.get('nut-button.jpg', 1024).size == (1024, 758)
+    cache.get('uno.jpg', 1024)
+    assert 'uno.jpg' in cache  # already small enough, shares the full size entry
+
+
+def test_scaled_plan_scales_plugin_geometry():
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'nut button')
+    plugin = get_plan(meme, 0.5).steps[1].plugin
+    assert (plugin.position.x, plugin.position.y, plugin.fontsize) == (488, 800, 135)
+    assert meme.plugins[1].fontsize == 270
+
+
+def test_font_registry_resolves_bundled_fonts():
+    registry = FontRegistry()
+    assert registry.resolve('impact').endswith('Impact.ttf')
+    assert registry.resolve('xkcd-script').endswith('xkcd-script.ttf')
+    assert registry.get('Impact', 48) is registry.get('Impact', 48)
+    assert registry.get('Impact', 48).size == 48
+
+
+@pytest.mark.asyncio
+async def test_executor_warms_fonts_on_every_thread():
+    registry = FontRegistry()
+    set_font_registry(registry)
+    executor = RenderExecutor(kind='thread', max_workers=3)
+    uno = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'uno')
+    barrier = threading.Barrier(3)
+
+    def loaded_fonts():
+        barrier.wait(5)  # one job per thread
+        return set(getattr(registry._local, 'fonts', {}))
+
+    try:
+        await executor.warm([uno])
+        loaded = await asyncio.gather(*(executor.run(loaded_fonts) for _ in range(3)))
+    finally:
+        executor.shutdown(wait=True)
+        set_font_registry(None)
+    fonts = uno.fonts(template_scale(uno.image_filename, DEFAULT_MAX_DIMENSION))
+    assert fonts and all(fonts <= thread_fonts for thread_fonts in loaded)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('alias', [meme.aliases[0] for meme in ALL_MEMES if meme.aliases[0] != 'brain'])
+async def test_generate(alias: str):
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == alias)
+    async with meme.generate('top text / bottom text / more text') as meme_file:
+        with Image.open(meme_file) as image:
+            scale = template_scale(meme.image_filename, DEFAULT_MAX_DIMENSION)
+            assert image.size == tuple(round(length * scale) for length in template_size(meme.image_filename))
+            assert max(image.size) <= DEFAULT_MAX_DIMENSION
+
+
+@pytest.mark.parametrize('outline', list(OutlineMode))
+def test_draw_text_outline_modes(outline: OutlineMode):
+    image = Image.new('RGB', (200, 100), 'gray')
+    DrawText(plugin_input=UserInput(), outline=outline).draw(image, 'hi')
+    colors = set(color for _, color in image.getcolors())
+    assert (255, 255, 255) in colors and (0, 0, 0) in colors
+
+
+@pytest.mark.asyncio
+async def test_render_cache_hits_memory_then_disk(tmp_path):
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'uno')
+    cache = RenderCache(directory=str(tmp_path))
+    async with meme.generate('draw  25 / me', cache=cache) as meme_file:
+        rendered = meme_file.read()
+    async with meme.generate('draw 25 / me ', cache=cache) as meme_file:
+        assert meme_file.read() == rendered
+    assert (cache.misses, cache.memory_hits) == (1, 1)
+
+    cache = RenderCache(directory=str(tmp_path))
+    async with meme.generate('draw 25 / me', cache=cache) as meme_file:
+        assert meme_file.read() == rendered
+    assert cache.disk_hits == 1
+
+
+def test_render_cache_skips_urls():
+    assert RenderCache().key(ALL_MEMES[0], 'https://example.com/a.png') is None
+
+
+@pytest.mark.asyncio
+async def test_singleflight_shares_result():
+    singleflight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b'meme'
+
+    results = await asyncio.gather(*(singleflight.do('key', work) for _ in range(3)))
+    assert results == [b'meme'] * 3
+    assert len(calls) == 1
+    assert len(singleflight) == 0
+
+
+@pytest.mark.asyncio
+async def test_singleflight_propagates_leader_error():
+    singleflight = SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.01)
+        raise ValueError('bad meme')
+
+    results = await asyncio.gather(*(singleflight.do('key', work) for _ in range(2)), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_singleflight_cancelling_leader_keeps_work_for_others():
+    singleflight = SingleFlight()
+    started = asyncio.Event()
+
+    async def work():
+        started.set()
+        await asyncio.sleep(0.01)
+        return b'meme'
+
+    leader = asyncio.create_task(singleflight.do('key', work))
+    await started.wait()
+    follower = asyncio.create_task(singleflight.do('key', work))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == b'meme'
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+
+def test_layout_cache_reuses_layout():
+    layout_cache = LayoutCache()
+    set_layout_cache(layout_cache)
+    try:
+        draw_text = DrawText(plugin_input=UserInput()).compile_draw()
+        first, second = Image.new('RGB', (200, 100)), Image.new('RGB', (200, 100))
+        draw_text(first, 'always has been')
+        draw_text(second, 'always has been')
+        assert (layout_cache.misses, layout_cache.hits) == (1, 1)
+        assert first.tobytes() == second.tobytes()
+    finally:
+        set_layout_cache(None)
+
+
+def test_layout_cache_keys_on_text_style():
+    layout_cache = LayoutCache()
+    set_layout_cache(layout_cache)
+    try:
+        black, white = (DrawText(plugin_input=UserInput(), fit_box=Coordinate(x=180, y=60), textstyle=textstyle).compile_draw()
+            for textstyle in (TextStyle.BLACK, TextStyle.WHITE))
+        black(Image.new('RGB', (200, 100)), 'always has been')
+        cached = Image.new('RGB', (200, 100))
+        white(cached, 'always has been')
+        assert layout_cache.misses == 2
+
+        set_layout_cache(LayoutCache())
+        uncached = Image.new('RGB', (200, 100))
+        white(uncached, 'always has been')
+        assert cached.tobytes() == uncached.tobytes()
+    finally:
+        set_layout_cache(None)
+
+
+def test_draw_text_fits_box():
+    draw_text = DrawText(plugin_input=UserInput(), position=Coordinate(x=200, y=100),
+        fontsize=200, fit_box=Coordinate(x=300, y=150)).compile_draw()
+    image = Image.new('RGB', (400, 200), 'gray')
+    layout = draw_text.layout(ImageDraw.Draw(image), image.size, 'a caption that is far too long for this box')
+    assert draw_text.min_fontsize <= layout.fontsize < 200
+    assert layout.width <= 300 and layout.height <= 150
+    assert all(line for line in layout.text.split('\n'))
+
+
+class CountingDraw:
+    '''ImageDraw counting the text measurements made with it'''
+
+    def __init__(self, draw: ImageDraw.ImageDraw):
+        self.draw = draw
+        self.measured = 0
+
+    def multiline_textbbox(self, *args, **kwargs):
+        self.measured += 1
+        return self.draw.multiline_textbbox(*args, **kwargs)
+
+
+def test_draw_text_fit_falls_back_within_iterations():
+    draw_text = DrawText(plugin_input=UserInput(), fontsize=320, fit_box=Coordinate(x=60, y=20)).compile_draw()
+    draw = CountingDraw(ImageDraw.Draw(Image.new('RGB', (400, 200))))
+    text = 'a caption that does not fit at any size'
+    fontsize, wrapped, _, _ = draw_text.fit(draw, text, (60, 20))
+    assert draw.measured <= MAX_FIT_ITERATIONS
+    assert fontsize == draw_text.min_fontsize
+    # wrapped leaving room for the outline, like every other size tried
+    font = get_font_registry().get(draw_text.font, fontsize)
+    assert wrapped == wrap_to_width(text, font, 60 - 2 * stroke_width(fontsize))
+
+
+@pytest.mark.asyncio
+async def test_generate_names_file_after_output_format():
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'uno')
+    async with meme.generate('draw 25 / me', policy=OutputPolicy(format=OutputFormat.WEBP)) as meme_file:
+        assert meme_file.name == 'uno.webp'
+        assert Image.open(meme_file).format == 'WEBP'
+
+
+@pytest.mark.asyncio
+async def test_meme_output_keeps_policy_limits(executor: RenderExecutor):
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'nut button')
+    assert meme.output is not None and meme.output.max_bytes is None
+    policy = OutputPolicy(format=OutputFormat.PNG, max_bytes=20_000, max_dimension=400)
+    assert meme.output_policy(policy).format == OutputFormat.JPEG
+    encoded = await meme.render('tests / green', executor=executor, policy=policy)
+    assert encoded.format == 'JPEG'
+    assert len(encoded.data) <= 20_000
+    assert max(Image.open(io.BytesIO(encoded.data)).size) <= 400
+
+
+@pytest.mark.parametrize('output_format', [OutputFormat.JPEG, OutputFormat.PNG])
+def test_encode_fits_under_max_bytes(output_format: OutputFormat):
+    image = Image.open(template_path('always-has-been.png'))
+    encoded = encode(image, OutputPolicy(format=output_format, max_bytes=100_000))
+    assert len(encoded.data) <= 100_000
+    assert encoded.format == output_format.name
+
+
+def test_decode_image_reduces_large_jpegs():
+    photo = io.BytesIO()
+    Image.new('RGB', (4000, 3000), 'blue').save(photo, format='JPEG')
+    assert decode_image(photo.getvalue(), (400, 400)).size == (400, 300)
+    with pytest.raises(ImageDecodeError):
+        decode_image(photo.getvalue(), (400, 400), max_pixels=1000 * 1000)
+
+
+@pytest.mark.parametrize('mode, image_format', [('P', 'GIF'), ('P', 'PNG'), ('1', 'PNG'), ('I;16', 'PNG')])
+def test_decode_image_reduces_any_mode(mode: str, image_format: str):
+    image = io.BytesIO()
+    Image.effect_noise((1200, 900), 64).convert(mode).save(image, format=image_format)
+    assert decode_image(image.getvalue(), (100, 100)).size == (100, 75)
+
+
+def test_decode_image_stops_once_over_time_budget(monkeypatch):
+    png = io.BytesIO()
+    Image.effect_noise((1000, 1000), 64).save(png, format='PNG')
+    # a clock that moves a second every time it's read, so the budget counts deadline checks
+    clock = itertools.count()
+    monkeypatch.setattr(drawimage, 'time', types.SimpleNamespace(perf_counter=lambda: next(clock)))
+
+    with pytest.raises(ImageDecodeError):
+        decode_image(png.getvalue(), (300, 300), time_budget=10)
+    # stopped a few blocks in, well before the end of the image
+    assert next(clock) < 20
+
+    clock = itertools.count()
+    assert decode_image(png.getvalue(), (300, 300), time_budget=1000).size == (300, 300)
+    assert next(clock) > 20
+
+
+@pytest.mark.asyncio
+async def test_image_fetcher_streams_with_limits():
+    png = io.BytesIO()
+    Image.new('RGB', (10, 10)).save(png, format='PNG')
+    bodies = {'image': png.getvalue(), 'page': b'<html>not a meme</html>', 'huge': png.getvalue() + bytes(100_000)}
+
+    async def handler(request: web.Request):
+        return web.Response(body=bodies[request.match_info['name']])
+
+    app = web.Application()
+    app.router.add_get('/{name:(image|page|huge)}', handler)
+
+    async with TestServer(app) as server:
+        fetcher = ImageFetcher(max_bytes=50_000)
+        try:
+            assert await fetcher.fetch(str(server.make_url('/image'))) == png.getvalue()
+            for path in ('/page', '/huge', '/missing'):
+                with pytest.raises(FetchError):
+                    await fetcher.fetch(str(server.make_url(path)))
+        finally:
+            await fetcher.close()
+
+
+@pytest.mark.asyncio
+async def test_remote_image_cache_revalidates_with_etag(tmp_path):
+    png = io.BytesIO()
+    Image.new('RGB', (10, 10)).save(png, format='PNG')
+    downloads = []
+
+    async def handler(request: web.Request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        downloads.append(request.path)
+        return web.Response(body=png.getvalue(), headers={'ETag': '"v1"'})
+
+    app = web.Application()
+    app.router.add_get('/avatar.png', handler)
+    async with TestServer(app) as server:
+        fetcher = ImageFetcher()
+        url = str(server.make_url('/avatar.png'))
+        try:
+            cache = RemoteImageCache(directory=str(tmp_path), fresh_seconds=60, fetcher=fetcher)
+            first = await cache.get(url)
+            assert (await cache.get(url)).digest == first.digest
+
+            cache = RemoteImageCache(directory=str(tmp_path), fresh_seconds=0, fetcher=fetcher)
+            assert (await cache.get(url)).data == png.getvalue()
+        finally:
+            await fetcher.close()
+    assert downloads == ['/avatar.png']
+    assert (cache.misses, cache.revalidated) == (0, 1)
+
+
+def test_remote_image_cache_drops_unreadable_metadata(tmp_path):
+    sidecars = {
+        'good': '{"url": "a", "digest": "d", "etag": null, "last_modified": null, "checked_at": 0}',
+        'missing': '{"url": "a"}',
+        'unknown': '{"url": "a", "digest": "d", "etag": null, "last_modified": null, "checked_at": 0, "size": 1}',
+        'list': '[]',
+        'truncated': '{"url": ',
+    }
+    for key, meta in sidecars.items():
+        (tmp_path / key).write_bytes(b'image')
+        (tmp_path / f'{key}.json').write_text(meta)
+    cache = RemoteImageCache(directory=str(tmp_path))
+    assert len(cache) == 1
+    assert sorted(os.listdir(tmp_path)) == ['good', 'good.json']
+
+
+@pytest.mark.asyncio
+async def test_render_batch_streams_results_and_errors(executor: RenderExecutor):
+    memes = {meme.aliases[0]: meme for meme in ALL_MEMES}
+    jobs = [BatchJob('1', memes['uno'], 'a / b'), BatchJob('2', memes['drake'], 'a / b'),
+        BatchJob('3', memes['uno'], 'c / d'), BatchJob('4', memes['uno'], 'missing second line')]
+    assert [job.id for job in group_by_template(jobs)] == ['1', '3', '4', '2']
+
+    results = {result.job.id: result async for result in render_batch(jobs, executor=executor)}
+    assert sorted(results) == ['1', '2', '3', '4']
+    assert isinstance(results['4'].error, ValueError)
+    assert all(results[id].encoded.data for id in ('1', '2', '3'))
+
+
+@pytest.mark.asyncio
+async def test_render_batch_on_render_farm():
+    memes = {meme.aliases[0]: meme for meme in ALL_MEMES}
+    jobs = [BatchJob('1', memes['uno'], 'a / b'), BatchJob('2', memes['drake'], 'a / b')]
+    farm = RenderFarm(max_workers=1)
+    try:
+        results = [result async for result in render_batch(jobs, executor=farm)]
+    finally:
+        farm.shutdown(wait=True)
+    assert [result.error for result in results] == [None, None]
+    assert all(result.encoded.data for result in results)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('memory', [False, True])
+async def test_profile_reports_every_stage(executor: RenderExecutor, memory: bool):
+    meme = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'drake')
+    reports = []
+    await meme.render('no / yes', executor=executor, profile=Profile(lambda meme, spans: reports.append(spans), memory=memory))
+    [spans] = reports
+    names = [span.name for span in spans]
+    assert names[0] == 'prepare 0:SplitText'
+    assert names.index('template') < names.index('draw 1:DrawText') < names.index('encode')
+    assert all(span.seconds >= 0 for span in spans)
+    assert all((span.allocated_bytes is not None) == memory for span in spans)
+
+
+DRAKE_DEFINITION = '''
+{
+    "image_filename": "drake.jpg",
+    "aliases": ["json drake"],
+    "help_string": "Usage: !meme json drake <top> / <bottom>",
+    "output": {"format": "jpeg", "quality": 80},
+    "plugins": [
+        {"type": "SplitText", "plugin_input": {"type": "UserInput"}},
+        {"type": "DrawText", "plugin_input": {"type": "ContextInput", "key": "text-1"},
+            "position": {"x": 900, "y": 300}, "textstyle": "BLACK"},
+        {"type": "DrawText", "plugin_input": {"type": "ContextInput", "key": "text-2"}, "position": "BOTTOM"}
+    ]
+}
+'''
+
+UNO_DEFINITION = '''
+[[memes]]
+image_filename = "uno.jpg"
+aliases = ["toml uno"]
+help_string = "Usage: !meme toml uno <text>"
+plugins = [
+    {type = "DrawText", plugin_input = {type = "UserInput"}, position = {x = 300, y = 300}},
+]
+'''
+
+
+@pytest.mark.asyncio
+async def test_meme_library_reloads_changed_files(tmp_path, executor: RenderExecutor):
+    (tmp_path / 'drake.json').write_text(DRAKE_DEFINITION)
+    (tmp_path / 'uno.toml').write_text(UNO_DEFINITION)
+    library = MemeLibrary(str(tmp_path))
+    changes = library.reload()
+    assert sorted(meme.aliases[0] for meme in changes.added) == ['json drake', 'toml uno']
+    drake = next(meme for meme in library.memes if meme.aliases[0] == 'json drake')
+    assert drake.plugins[1].textstyle == TextStyle.BLACK
+    assert drake.plugins[2].position == AutoPosition.BOTTOM
+    assert (await drake.render('no / yes', executor=executor)).format == 'JPEG'
+
+    assert not library.reload()
+
+    # only the edited file's meme gets replaced, a broken file keeps its memes
+    os.utime(tmp_path / 'drake.json', ns=(0, 0))
+    (tmp_path / 'uno.toml').write_text(UNO_DEFINITION.replace('300}', '310}'))
+    changes = library.reload()
+    assert [meme.aliases[0] for meme in changes.added] == ['toml uno']
+    assert [meme.aliases[0] for meme in changes.removed] == ['toml uno']
+    assert drake in library.memes
+
+    (tmp_path / 'drake.json').write_text('{"plugins": [{"type": "NoSuchPlugin"}]}')
+    assert not library.reload()
+    assert drake in library.memes
+
+    (tmp_path / 'uno.toml').unlink()
+    assert [meme.aliases[0] for meme in library.reload().removed] == ['toml uno']
+
+
+def test_meme_library_reads_yaml(tmp_path):
+    pytest.importorskip('yaml')
+    (tmp_path / 'drake.yml').write_text(
+        'image_filename: drake.jpg\naliases: [yaml drake]\nhelp_string: ""\n'
+        'plugins:\n  - type: DrawText\n    plugin_input: {type: UserInput}\n    position: TOP\n')
+    library = MemeLibrary(str(tmp_path))
+    assert [meme.aliases[0] for meme in library.reload().added] == ['yaml drake']
+
+    (tmp_path / 'drake.yml').write_text('plugins: [')
+    os.utime(tmp_path / 'drake.yml', ns=(0, 0))
+    assert not library.reload()
+    assert [meme.aliases[0] for meme in library.memes] == ['yaml drake']
+
+
+def test_parse_meme_rejects_unknown_plugins():
+    with pytest.raises(MemeDefinitionError):
+        parse_meme(dict(image_filename='drake.jpg', aliases=['x'], help_string='', plugins=[dict(type='Nope')]))
+
+
+def test_meme_registry_resolves_normalized_aliases():
+    registry = MemeRegistry(ALL_MEMES)
+    match = registry.resolve('  Change   MY mind  pineapple on pizza')
+    assert match.meme.aliases[0] == 'change my mind'
+    assert match.end == len('  Change   MY mind')
+    assert match.text == 'pineapple on pizza'
+    assert registry.resolve('drake no / yes').text == 'no / yes'
+    assert registry.resolve('no such meme') is None
+
+    drake = registry.get('DRAKE')
+    with pytest.raises(MemeRegistryError):
+        registry.add(drake.model_copy(update=dict(aliases=['other drake', 'Drake'])))
+    registry.remove(drake)
+    assert registry.resolve('drake no / yes') is None
+
+
+@pytest.mark.parametrize('command, expected', [
+    ('distractd boyfriend look at her', 'distracted bf'),
+    ('chnage my mind pineapple on pizza', 'change my mind'),
+    ('Spongbob hello', 'spongebob'),
+])
+def test_meme_registry_suggests_close_aliases(command: str, expected: str):
+    registry = MemeRegistry(ALL_MEMES)
+    assert registry.resolve(command) is None
+    assert registry.suggest(command)[0].aliases[0] == expected
+    assert registry.suggest('qqqq zzzz') == []
+
+
+@pytest.mark.asyncio
+async def test_animated_template_renders_every_frame(tmp_path, executor: RenderExecutor):
+    # the middle two frames are the same, so they get merged into one shown twice as long
+    frames = [Image.new('RGB', (200, 100), color) for color in ('red', 'green', 'green', 'blue')]
+    frames[0].save(tmp_path / 'flash.gif', save_all=True, append_images=frames[1:], duration=50, loop=0)
+    meme = parse_meme(dict(image_filename='flash.gif', aliases=['flash'], help_string='',
+        plugins=[dict(type='DrawText', plugin_input=dict(type='UserInput'), fontsize=24)]), str(tmp_path))
+
+    encoded = await meme.render('hello', executor=executor)
+    assert encoded.format == 'GIF'
+    with Image.open(io.BytesIO(encoded.data)) as image:
+        assert image.n_frames == 3
+        durations = []
+        for frame in range(image.n_frames):
+            image.seek(frame)
+            durations.append(image.info['duration'])
+            # the caption is drawn on every frame, the background still shows around it
+            assert len(image.convert('RGB').getcolors(256)) > 2
+        assert durations == [50, 100, 50]
+
+
+def test_write_gif_merges_unchanged_frames():
+    red, blue = Image.new('RGB', (20, 20), 'red'), Image.new('RGB', (20, 10), 'blue')
+    palette = [(255, 0, 0), (0, 0, 255)]
+    updates = [FrameUpdate(red, (0, 0), 50, {palette[0]}), FrameUpdate(None, (0, 0), 30),
+        FrameUpdate(blue, (0, 10), 50, {palette[1]})]
+    output = io.BytesIO()
+    assert write_gif(output, iter(updates), palette) == 2
+    with Image.open(io.BytesIO(output.getvalue())) as image:
+        assert image.n_frames == 2
+        assert image.info['duration'] == 80
+        image.seek(1)
+        assert sorted(image.convert('RGB').getcolors()) == [(200, (0, 0, 255)), (200, (255, 0, 0))]
+
+
+# prepared value of every SlowFetch draw, and whether `downloads` was released by then
+drawn = []
+first_drawn = threading.Event()
+downloads: Optional[asyncio.Event] = None
+
+
+class SlowFetch(BasePlugin):
+    '''Stands in for a download. With `io_bound` off, it's a plugin that prepares right away.'''
+    io_bound: ClassVar[bool] = True
+    output_key: Optional[str] = None
+
+    def output_keys(self) -> Tuple[str, ...]:
+        return (self.output_key,) if self.output_key else ()
+
+    async def prepare(self, text: str, context: Dict):
+        await asyncio.sleep(0.1)
+        if self.output_key:
+            context[self.output_key] = text.upper()
+        return text
+
+    def draw(self, image: Image.Image, prepared):
+        drawn.append((prepared, downloads is not None and downloads.is_set()))
+        first_drawn.set()
+
+
+class InstantText(SlowFetch):
+    io_bound: ClassVar[bool] = False
+
+    async def prepare(self, text: str, context: Dict):
+        return text
+
+
+class GatedFetch(SlowFetch):
+    '''A download that only finishes once `downloads` is set'''
+
+    async def prepare(self, text: str, context: Dict):
+        await downloads.wait()
+        return text
+
+
+def test_plan_links_plugins_through_context_keys():
+    brain = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'brain')
+    assert [step.depends for step in get_plan(brain).steps] == [(), (0,), (0,), (0,)]
+    spongebob = next(meme for meme in ALL_MEMES if meme.aliases[0] == 'spongebob')
+    assert [step.depends for step in get_plan(spongebob).steps] == [(), (0,)]
+
+
+@pytest.mark.asyncio
+async def test_prepare_runs_independent_fetches_concurrently():
+    meme = Meme(image_filename='brain.jpg', aliases=['slow'], help_string='', plugins=[
+        SplitText(plugin_input=UserInput()),
+        SlowFetch(plugin_input=ContextInput(key='text-1')),
+        SlowFetch(plugin_input=ContextInput(key='text-2'), output_key='fetched'),
+        # waits for the fetch writing its input, runs alongside the last one
+        SlowFetch(plugin_input=ContextInput(key='fetched')),
+        SlowFetch(plugin_input=ContextInput(key='text-3')),
+    ])
+    start = time.perf_counter()
+    steps = await meme.prepare('a / b / c')
+    assert time.perf_counter() - start < 0.3
+    assert steps == [(1, 'a'), (2, 'b'), (3, 'B'), (4, 'c')]
+
+
+@pytest.mark.asyncio
+async def test_render_starts_before_downloads_finish():
+    global downloads
+    downloads = asyncio.Event()
+    drawn.clear()
+    first_drawn.clear()
+    executor = RenderExecutor(kind='thread', max_workers=2)
+    meme = Meme(image_filename='brain.jpg', aliases=['slow'], help_string='', plugins=[
+        SplitText(plugin_input=UserInput()),
+        InstantText(plugin_input=ContextInput(key='text-1')),
+        GatedFetch(plugin_input=ContextInput(key='text-2')),
+        InstantText(plugin_input=ContextInput(key='text-3')),
+    ])
+    render = asyncio.ensure_future(meme.render('a / b / c', executor=executor))
+    try:
+        # the first panel gets drawn while the download is held back
+        assert await asyncio.get_running_loop().run_in_executor(None, first_drawn.wait, 10)
+        downloads.set()
+        await render
+    finally:
+        downloads.set()
+        await asyncio.gather(render, return_exceptions=True)
+        executor.shutdown(wait=True)
+    # the rest are drawn in order once the download is done
+    assert drawn == [('a', False), ('b', True), ('c', True)]
+    assert executor.waiting_renders == 0